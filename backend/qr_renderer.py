@@ -0,0 +1,34 @@
+"""QR code rendering, executed in worker processes.
+
+Kept apart from server.py so pool workers, started from a forkserver, can
+import it without loading the API module (Mongo client, startup tasks) in
+every process.
+"""
+import base64
+from io import BytesIO
+
+import qrcode
+import qrcode.image.svg
+
+QR_MIME_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+def render_qr(data: str, image_format: str = "png", box_size: int = 10, border: int = 5):
+    """Render `data` as base64 PNG/SVG, or as a 0/1 module matrix for clients that draw it themselves"""
+    qr = qrcode.QRCode(version=1, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    
+    if image_format == "matrix":
+        return [[1 if module else 0 for module in row] for row in qr.get_matrix()]
+    
+    buffered = BytesIO()
+    if image_format == "svg":
+        img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+        img.save(buffered)
+    else:
+        img = qr.make_image(fill_color="black", back_color="white")
+        img.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode()
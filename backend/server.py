@@ -1,27 +1,35 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any, Union
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 import jwt
 from passlib.context import CryptContext
 import hashlib
+import hmac
 import asyncio
 import json
 import base64
-import qrcode
-from io import BytesIO
+import multiprocessing
+import numpy as np
 import secrets
 import re
+from qr_renderer import QR_MIME_TYPES, render_qr
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -36,6 +44,30 @@ SECRET_KEY = "impulsa-guayaquil-secret-key-2025"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# QR check-in tokens
+QR_TOKEN_TTL_MINUTES = 5
+# Signed tokens are verified without a qr_tokens read and never stored
+QR_STATELESS_TOKENS = os.environ.get("QR_STATELESS_TOKENS", "false").lower() == "true"
+QR_TOKEN_SECRET = os.environ.get("QR_TOKEN_SECRET", SECRET_KEY).encode()
+SIGNED_QR_TOKEN_PREFIX = "v1."
+UNIX_EPOCH = datetime(1970, 1, 1)
+QR_VERIFY_BATCH_MAX = int(os.environ.get("QR_VERIFY_BATCH_MAX", 200))
+# How long after expiry an offline scanner can still sync scans of a signed token
+QR_OFFLINE_SYNC_WINDOW_HOURS = int(os.environ.get("QR_OFFLINE_SYNC_WINDOW_HOURS", 24))
+
+# QR rendering
+QR_RENDER_WORKERS = int(os.environ.get("QR_RENDER_WORKERS", 2))
+QR_MAX_BOX_SIZE = 40
+
+# Authenticated user cache
+USER_CACHE_TTL_SECONDS = int(os.environ.get("USER_CACHE_TTL_SECONDS", 60))
+USER_CACHE_MAX_SIZE = int(os.environ.get("USER_CACHE_MAX_SIZE", 10000))
+
+# Password hashing pool
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", 32))
+PASSWORD_POOL_RETRY_AFTER_SECONDS = 2
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
@@ -154,6 +186,11 @@ class EventType(str, Enum):
     NETWORKING = "networking"
     PITCH_COMPETITION = "pitch_competition"
 
+class QRImageFormat(str, Enum):
+    PNG = "png"
+    SVG = "svg"
+    MATRIX = "matrix"
+
 class RewardType(str, Enum):
     DISCOUNT = "discount"
     TRAINING = "training"
@@ -187,6 +224,18 @@ class CompetenceArea(str, Enum):
     MARKETING = "marketing"
     INNOVACION = "innovacion"
 
+class OutboxStatus(str, Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+class BackfillStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
 # Security functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -194,6 +243,59 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHashingPool:
+    """Runs bcrypt off the event loop with a hard cap on queued work.
+
+    bcrypt releases the GIL while hashing, so a thread pool gives real
+    parallelism. Once `workers + max_queue` calls are in flight new calls are
+    rejected with 503 instead of piling up behind a login burst.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Authentication service is busy, please retry shortly",
+                headers={"Retry-After": str(PASSWORD_POOL_RETRY_AFTER_SECONDS)},
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+password_pool = PasswordHashingPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password) -> str:
+    return await password_pool.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -204,7 +306,75 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class UserPrincipalCache:
+    """Bounded LRU of authenticated users keyed by user id.
+
+    Entries expire after the configured TTL or at the token's `exp`, whichever
+    comes first. Writes made by this process call invalidate(); writes made by
+    other workers become visible once the TTL runs out.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple[float, User]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str) -> Optional["User"]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: str, user: "User", token_exp: Optional[float] = None):
+        ttl = self.ttl_seconds
+        if token_exp is not None:
+            ttl = min(ttl, token_exp - time.time())
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+user_principal_cache = UserPrincipalCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
+# Heavy fields left out of the principal built by get_current_user
+AUTH_USER_PROJECTION = {
+    "_id": 0,
+    "profile_picture": 0,
+    "failed_missions": 0,
+    "badges": 0,
+    "favorite_rewards": 0
+}
+
+def invalidate_cached_user(user_id: str):
+    """Drop a user's cached principal after writing to their document"""
+    user_principal_cache.invalidate(user_id)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> "User":
+    """Resolve the bearer token to a slim User principal (shared, treat as read-only)"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -218,10 +388,17 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.PyJWTError:
         raise credentials_exception
     
-    user = await db.users.find_one({"id": user_id})
+    cached_user = user_principal_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
+    user = await db.users.find_one({"id": user_id}, AUTH_USER_PROJECTION)
     if user is None:
         raise credentials_exception
-    return User(**user)
+    
+    user_obj = User(**user)
+    user_principal_cache.put(user_id, user_obj, payload.get("exp"))
+    return user_obj
 
 async def get_admin_user(current_user: "User" = Depends(get_current_user)) -> "User":
     if current_user.role not in [UserRole.ADMIN, UserRole.CURADOR_CONTENIDOS]:
@@ -268,6 +445,8 @@ class User(BaseModel):
     ciudad: str = "Guayaquil"  # Para sistema de ligas
     cohorte: Optional[str] = None  # Para agrupaciones
     weekly_xp: int = 0  # XP semanal para ligas
+    # Bit n activo si la misión con ordinal n está completada; derivado de completed_missions
+    completed_missions_bitmap: Optional[bytes] = Field(default=None, exclude=True)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -345,6 +524,7 @@ class Mission(BaseModel):
     auto_approve: bool = True  # Si la evidencia se aprueba automáticamente
     difficulty_level: int = 1  # 1-5
     estimated_time: int = 30  # minutos
+    ordinal: Optional[int] = None  # Posición en completed_missions_bitmap, asignada una sola vez
     created_at: datetime = Field(default_factory=datetime.utcnow)
     created_by: str = ""
     
@@ -464,6 +644,7 @@ class EligibilityRule(BaseModel):
     condition: str  # JSON DSL simple, ej: {"and": [{"missions": ["id1", "id2"]}, {"documents": ["ruc"]}, {"points": {"min": 500}}]}
     weight: float = 1.0  # Peso de esta regla (0-1)
     description: str = ""
+    version: int = 1  # Se incrementa cuando cambia la condición; invalida la regla compilada
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class EligibilityRuleCreate(BaseModel):
@@ -547,6 +728,18 @@ class QRToken(BaseModel):
     used_at: Optional[datetime] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class QRScan(BaseModel):
+    token: str
+    scanned_at: Optional[datetime] = None  # Hora del escaneo en el dispositivo (modo offline)
+
+class QRBatchVerify(BaseModel):
+    tokens: List[str]
+    device_id: Optional[str] = None
+
+class QROfflineSync(BaseModel):
+    device_id: str
+    scans: List[QRScan]
+
 class Reward(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
@@ -556,6 +749,7 @@ class Reward(BaseModel):
     coins_cost: int  # Cambio de points_cost a coins_cost
     stock: int = -1  # -1 significa stock ilimitado
     stock_consumed: int = 0
+    is_available: bool = True  # stock == -1 or stock_consumed < stock, kept in sync on every stock change
     external_url: Optional[str] = None
     qr_code: Optional[str] = None  # Para canjes físicos
     available_until: Optional[datetime] = None
@@ -638,6 +832,19 @@ class Notification(BaseModel):
     read: bool = False
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class OutboxEvent(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    type: str
+    payload: Dict[str, Any] = {}
+    status: OutboxStatus = OutboxStatus.PENDING
+    attempts: int = 0
+    available_at: datetime = Field(default_factory=datetime.utcnow)
+    claim_token: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    processed_at: Optional[datetime] = None
+
 class Badge(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
@@ -655,6 +862,37 @@ class UserBadge(BaseModel):
     badge_id: str
     earned_at: datetime = Field(default_factory=datetime.utcnow)
     progress: float = 1.0
+    awarded_by: Optional[str] = None  # backfill job that inserted the row
+
+class BadgeProgress(BaseModel):
+    """Per-user counters badge predicates are evaluated against, kept up to date incrementally"""
+    user_id: str
+    missions_completed: int = 0
+    points: int = 0
+    current_streak: int = 0
+    area_missions: Dict[str, int] = {}
+    type_missions: Dict[str, int] = {}
+    counted_missions: List[str] = []  # completions already applied, so replays are no-ops
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    def scoped_count(self, predicate: "BadgePredicate", catalog: "MissionCatalog") -> int:
+        counts = self.area_missions if predicate.metric == "area_missions" else self.type_missions
+        return counts.get(predicate.scope, 0)
+
+class BadgeBackfillJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    badge_id: str
+    status: BackfillStatus = BackfillStatus.PENDING
+    last_user_id: Optional[str] = None  # checkpoint: users are swept in id order
+    users_processed: int = 0
+    badges_awarded: int = 0
+    elapsed_seconds: float = 0.0
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    completed_at: Optional[datetime] = None
 
 class AdminStats(BaseModel):
     total_users: int
@@ -691,11 +929,244 @@ class ImpactMetrics(BaseModel):
     knowledge_improvement: float
     business_survival_rate: float
 
+# Index registry
+# Every index the API relies on, declared per collection. Keys mirror the real
+# query shapes used by the routes below.
+INDEX_REGISTRY: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("cedula", ASCENDING)], name="cedula_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("last_activity", DESCENDING)], name="last_activity"),
+        IndexModel([("ciudad", ASCENDING), ("cohorte", ASCENDING)], name="ciudad_cohorte"),
+        # Only users with completion events still waiting for the outbox relay
+        IndexModel([("pending_events.id", ASCENDING)], name="pending_events_id", sparse=True),
+    ],
+    "missions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("competence_area", ASCENDING), ("position", ASCENDING)], name="competence_area_position"),
+        IndexModel([("type", ASCENDING)], name="type"),
+    ],
+    "events": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("date", ASCENDING)], name="date"),
+    ],
+    "rewards": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("ciudad", ASCENDING), ("reward_type", ASCENDING), ("is_available", ASCENDING), ("available_until", ASCENDING)],
+            name="ciudad_reward_type_is_available_available_until"
+        ),
+    ],
+    "badges": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "evidences": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("uploaded_at", ASCENDING)], name="status_uploaded_at"),
+        IndexModel([("user_id", ASCENDING), ("mission_id", ASCENDING)], name="user_id_mission_id"),
+    ],
+    "documents": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING)], name="user_id_status"),
+    ],
+    "qr_tokens": [
+        IndexModel([("token", ASCENDING)], name="token_unique", unique=True),
+        IndexModel([("event_id", ASCENDING)], name="event_id"),
+    ],
+    "qr_token_uses": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Single-use markers only need to outlive the token they guard
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "notifications": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("user_id", ASCENDING), ("read", ASCENDING), ("created_at", DESCENDING)],
+            name="user_id_read_created_at"
+        ),
+    ],
+    "user_badges": [
+        IndexModel([("user_id", ASCENDING), ("badge_id", ASCENDING)], name="user_id_badge_id", unique=True),
+    ],
+    "mission_attempts": [
+        IndexModel([("mission_id", ASCENDING), ("status", ASCENDING)], name="mission_id_status"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ],
+    "eligibility_rules": [
+        IndexModel([("event_id", ASCENDING)], name="event_id"),
+    ],
+    "event_eligibilities": [
+        IndexModel([("event_id", ASCENDING), ("user_id", ASCENDING)], name="event_id_user_id", unique=True),
+    ],
+    "reward_redemptions": [
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("reward_id", ASCENDING)], name="reward_id"),
+    ],
+    "outbox": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel([("claim_token", ASCENDING)], name="claim_token", sparse=True),
+        # Delivered events are kept for a week for inspection
+        IndexModel([("processed_at", ASCENDING)], name="processed_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    "idempotency_keys": [
+        IndexModel([("user_id", ASCENDING), ("key", ASCENDING)], name="user_id_key_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "catalog_state": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "badge_progress": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "badge_backfill_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("badge_id", ASCENDING), ("status", ASCENDING)], name="badge_id_status"),
+    ],
+    "leagues": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("is_active", ASCENDING), ("start_date", ASCENDING), ("end_date", ASCENDING)], name="is_active_dates"),
+    ],
+}
+
+# Server error codes for an existing index with the same name but other options/keys
+INDEX_CONFLICT_CODES = {85, 86}
+
+async def dedupe_user_badges() -> int:
+    """Delete repeated (user_id, badge_id) awards, keeping the earliest of each"""
+    duplicates = db.user_badges.aggregate([
+        {"$sort": {"earned_at": 1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "badge_id": "$badge_id"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    extra = []
+    async for group in duplicates:
+        extra.extend(group["ids"][1:])
+    if extra:
+        await db.user_badges.delete_many({"_id": {"$in": extra}})
+    return len(extra)
+
+# One-off cleanups that must run before a unique index can be built over old data
+INDEX_DEDUPES = {
+    ("user_badges", "user_id_badge_id"): dedupe_user_badges,
+}
+
+async def ensure_indexes() -> Dict[str, List[str]]:
+    """Build every index in INDEX_REGISTRY, rebuilding the ones whose definition changed"""
+    built = {}
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        built[collection_name] = []
+        for index in indexes:
+            name = index.document["name"]
+            dedupe = INDEX_DEDUPES.get((collection_name, name))
+            if dedupe:
+                existing = (await collection.index_information()).get(name, {})
+                if not existing.get("unique"):
+                    removed = await dedupe()
+                    if removed:
+                        print(f"Removed {removed} duplicate documents from {collection_name} before building {name}")
+            try:
+                try:
+                    await collection.create_indexes([index])
+                except OperationFailure as e:
+                    if e.code not in INDEX_CONFLICT_CODES:
+                        raise
+                    await collection.drop_index(name)
+                    await collection.create_indexes([index])
+            except OperationFailure as e:
+                # e.g. duplicate values blocking a unique index; keep starting up.
+                # get_index_report flags the index as missing.
+                print(f"Could not build index {collection_name}.{name}: {e}")
+                continue
+            built[collection_name].append(name)
+    return built
+
+async def get_index_report() -> Dict[str, List[Dict[str, Any]]]:
+    """Declared vs. existing indexes per collection with $indexStats usage counters"""
+    report = {}
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        declared = {index.document["name"] for index in indexes}
+        declared_unique = {index.document["name"] for index in indexes if index.document.get("unique")}
+        existing = await collection.index_information()
+
+        usage = {}
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                usage[stat["name"]] = stat.get("accesses", {})
+        except OperationFailure:
+            # $indexStats is not available on every deployment (e.g. some shared tiers)
+            pass
+
+        entries = []
+        for name in sorted(declared | set(existing)):
+            info = existing.get(name, {})
+            accesses = usage.get(name, {})
+            entries.append({
+                "name": name,
+                "keys": info.get("key", []),
+                "unique": info.get("unique", False),
+                "declared": name in declared,
+                "present": name in existing,
+                # A uniqueness guarantee the code relies on but MongoDB is not enforcing
+                "unique_missing": name in declared_unique and not info.get("unique", False),
+                "ops": accesses.get("ops", 0),
+                "since": accesses.get("since")
+            })
+        report[collection_name] = entries
+    return report
+
+# QR renderer
+class QRRenderer:
+    """Renders QR codes on a process pool"""
+
+    def __init__(self, workers: int):
+        # Workers come from a forkserver that has only imported qr_renderer,
+        # never a fork of this multithreaded process and its Mongo client.
+        # They are only started on the first render.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["qr_renderer"])
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        self.rendered = 0
+
+    async def render(
+        self,
+        data: str,
+        image_format: QRImageFormat = QRImageFormat.PNG,
+        box_size: int = 10,
+        border: int = 5
+    ):
+        result = await asyncio.get_running_loop().run_in_executor(
+            self.executor, render_qr, data, image_format.value, box_size, border
+        )
+        self.rendered += 1
+        return result
+
+    async def render_data_uri(self, data: str, image_format: QRImageFormat = QRImageFormat.PNG, box_size: int = 10):
+        """PNG/SVG as a data URI; the matrix format is returned as-is"""
+        result = await self.render(data, image_format, box_size)
+        if image_format == QRImageFormat.MATRIX:
+            return result
+        return f"data:{QR_MIME_TYPES[image_format.value]};base64,{result}"
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rendered": self.rendered}
+
+qr_renderer = QRRenderer(QR_RENDER_WORKERS)
+
 # Initialize demo content
 async def initialize_demo_content():
     """Initialize comprehensive demo content"""
     # Clean up old missions that don't have competence_area
-    await db.missions.delete_many({"competence_area": {"$exists": False}})
+    cleanup = await db.missions.delete_many({"competence_area": {"$exists": False}})
+    if cleanup.deleted_count:
+        await mission_catalog_cache.changed()
     
     # Check if content already exists
     existing_missions = await db.missions.count_documents({})
@@ -1183,6 +1654,7 @@ async def initialize_demo_content():
     demo_missions.extend(innovation_missions)
     
     await db.missions.insert_many(demo_missions)
+    await mission_catalog_cache.changed()
     print(f"Initialized {len(demo_missions)} comprehensive missions")
     
     # Initialize demo rewards
@@ -1384,6 +1856,7 @@ async def initialize_demo_content():
     ]
     
     await db.badges.insert_many(demo_badges)
+    badge_rule_registry.invalidate()
     print(f"Initialized {len(demo_badges)} demo badges")
     
     # Initialize demo admin user
@@ -1395,7 +1868,7 @@ async def initialize_demo_content():
             cedula="0000000000",
             email="admin@impulsaguayaquil.com",
             nombre_emprendimiento="Sistema Administrativo",
-            hashed_password=get_password_hash("admin"),
+            hashed_password=await get_password_hash_async("admin"),
             role=UserRole.ADMIN,
             rank=UserRank.EMPRENDEDOR_MASTER,
             points=10000,
@@ -1405,104 +1878,235 @@ async def initialize_demo_content():
         await db.users.insert_one(admin_user.dict())
         print("Initialized demo admin user: 0000000000 / admin")
 
+async def run_startup_step(step):
+    """Run one startup migration, logging a failure instead of aborting the rest"""
+    try:
+        await step()
+    except Exception as e:
+        print(f"Startup step {step.__name__} failed: {e}")
+
 # Initialize demo content on startup
 async def startup_event():
-    await initialize_demo_content()
-
-# Call startup event
-asyncio.create_task(startup_event())
+    # Workers start first so completions keep getting their side effects
+    # delivered even if a migration below fails
+    outbox.start()
+    for step in (
+        ensure_indexes,
+        initialize_demo_content,
+        backfill_reward_availability,
+        assign_mission_ordinals,
+        mark_legacy_eligibility_stale
+    ):
+        await run_startup_step(step)
+    spawn_background(mission_catalog_cache.watch())
+    spawn_background(backfill_completed_bitmaps())
+    await run_startup_step(resume_badge_backfills)
+
+# Call startup event, keeping a reference so the task isn't garbage collected
+startup_task = asyncio.create_task(startup_event())
 
 # Eligibility Engine Functions
-async def evaluate_eligibility_rule(user: User, rule_condition: str) -> tuple[bool, float]:
-    """Evaluate a single eligibility rule for a user"""
-    try:
-        condition = json.loads(rule_condition)
-        return await evaluate_condition(user, condition)
-    except json.JSONDecodeError:
-        return False, 0.0
-
-async def evaluate_condition(user: User, condition: dict) -> tuple[bool, float]:
-    """Recursively evaluate conditions"""
-    if "and" in condition:
-        results = []
-        for sub_condition in condition["and"]:
-            result, score = await evaluate_condition(user, sub_condition)
-            results.append((result, score))
-        
-        # All conditions must be true
-        all_true = all(result for result, _ in results)
-        avg_score = sum(score for _, score in results) / len(results) if results else 0
-        return all_true, avg_score
-    
-    elif "or" in condition:
-        results = []
-        for sub_condition in condition["or"]:
-            result, score = await evaluate_condition(user, sub_condition)
-            results.append((result, score))
-        
-        # Any condition can be true
-        any_true = any(result for result, _ in results)
-        max_score = max(score for _, score in results) if results else 0
-        return any_true, max_score
-    
+# Rule conditions are parsed and compiled once into evaluator closures. The
+# closures are pure functions of EligibilityFacts, so all the data a set of
+# rules needs is fetched up front (one query per dependency) and reused by
+# every leaf.
+ELIGIBILITY_USER_PROJECTION = {"_id": 0, "id": 1, "points": 1, "current_streak": 1, "completed_missions": 1}
+ELIGIBILITY_BATCH_SIZE = int(os.environ.get("ELIGIBILITY_BATCH_SIZE", 1000))
+# Rough effort to gather and upload a missing document, used to rank suggestions
+DOCUMENT_SUGGESTION_ESTIMATED_MINUTES = 60
+
+class EligibilityFacts:
+    """User state read by compiled eligibility evaluators"""
+
+    def __init__(
+        self,
+        points: int = 0,
+        current_streak: int = 0,
+        completed_missions: Optional[List[str]] = None,
+        approved_documents: Optional[set] = None,
+        area_missions: Optional[Dict[str, List[str]]] = None
+    ):
+        self.points = points
+        self.current_streak = current_streak
+        self.completed_missions = set(completed_missions or [])
+        self.approved_documents = approved_documents or set()
+        self.area_missions = area_missions or {}
+
+class CompiledEligibilityRule:
+    """An eligibility rule compiled into an evaluator plus the data it depends on"""
+
+    def __init__(self, rule: EligibilityRule):
+        self.rule = rule
+        self.version = rule.version
+        self.source = rule.condition
+        self.mission_ids: set = set()
+        self.document_types: set = set()
+        self.competence_areas: set = set()
+        self.uses_points = False
+        self.uses_streak = False
+        # Evaluators of the and/or groups, keyed by id() of their parsed subtree
+        self.group_evaluators: Dict[int, Any] = {}
+        try:
+            self.condition = json.loads(rule.condition)
+        except json.JSONDecodeError:
+            self.condition = None
+        self.evaluate = _compile_condition(self.condition, self) if self.condition is not None else _never_met
+
+    @property
+    def needs_documents(self) -> bool:
+        return bool(self.document_types)
+
+def _never_met(facts: EligibilityFacts) -> tuple[bool, float]:
+    return False, 0.0
+
+def _compile_threshold(requirement, value_of):
+    if not isinstance(requirement, dict) or "min" not in requirement:
+        return _never_met
+    minimum = requirement["min"]
+
+    def evaluate_threshold(facts: EligibilityFacts) -> tuple[bool, float]:
+        value = value_of(facts)
+        score = min(1.0, value / minimum) if minimum else 1.0
+        return value >= minimum, score
+    return evaluate_threshold
+
+def _compile_condition(condition: Any, deps: CompiledEligibilityRule):
+    """Compile a parsed DSL condition into a closure, recording its dependencies on `deps`"""
+    if not isinstance(condition, dict):
+        return _never_met
+
+    if "and" in condition or "or" in condition:
+        is_and = "and" in condition
+        sub_conditions = condition["and"] if is_and else condition["or"]
+        if not isinstance(sub_conditions, list):
+            return _never_met
+        children = [_compile_condition(sub_condition, deps) for sub_condition in sub_conditions]
+
+        if is_and:
+            def evaluate_and(facts: EligibilityFacts) -> tuple[bool, float]:
+                results = [child(facts) for child in children]
+                # All conditions must be true
+                all_true = all(result for result, _ in results)
+                avg_score = sum(score for _, score in results) / len(results) if results else 0
+                return all_true, avg_score
+            deps.group_evaluators[id(condition)] = evaluate_and
+            return evaluate_and
+
+        def evaluate_or(facts: EligibilityFacts) -> tuple[bool, float]:
+            results = [child(facts) for child in children]
+            # Any condition can be true
+            any_true = any(result for result, _ in results)
+            max_score = max(score for _, score in results) if results else 0
+            return any_true, max_score
+        deps.group_evaluators[id(condition)] = evaluate_or
+        return evaluate_or
+
     elif "missions" in condition:
-        required_missions = condition["missions"]
-        completed_count = len([m for m in required_missions if m in user.completed_missions])
-        score = completed_count / len(required_missions) if required_missions else 0
-        return score == 1.0, score
-    
+        required_missions = list(condition["missions"] or [])
+        deps.mission_ids.update(required_missions)
+
+        def evaluate_missions(facts: EligibilityFacts) -> tuple[bool, float]:
+            completed_count = len([m for m in required_missions if m in facts.completed_missions])
+            score = completed_count / len(required_missions) if required_missions else 0
+            return score == 1.0, score
+        return evaluate_missions
+
     elif "documents" in condition:
-        required_docs = condition["documents"]
-        user_docs = await db.documents.find({"user_id": user.id, "status": "approved"}).to_list(100)
-        approved_doc_types = [doc["document_type"] for doc in user_docs]
-        
-        approved_count = len([doc for doc in required_docs if doc in approved_doc_types])
-        score = approved_count / len(required_docs) if required_docs else 0
-        return score == 1.0, score
-    
-    elif "points" in condition:
-        points_req = condition["points"]
-        if "min" in points_req:
-            return user.points >= points_req["min"], min(1.0, user.points / points_req["min"])
-        return False, 0.0
-    
-    elif "xp" in condition:
-        xp_req = condition["xp"]
-        if "min" in xp_req:
-            return user.points >= xp_req["min"], min(1.0, user.points / xp_req["min"])
-        return False, 0.0
-    
+        required_docs = list(condition["documents"] or [])
+        deps.document_types.update(required_docs)
+
+        def evaluate_documents(facts: EligibilityFacts) -> tuple[bool, float]:
+            approved_count = len([doc for doc in required_docs if doc in facts.approved_documents])
+            score = approved_count / len(required_docs) if required_docs else 0
+            return score == 1.0, score
+        return evaluate_documents
+
+    elif "points" in condition or "xp" in condition:
+        deps.uses_points = True
+        requirement = condition["points"] if "points" in condition else condition["xp"]
+        return _compile_threshold(requirement, lambda facts: facts.points)
+
     elif "streak" in condition:
-        streak_req = condition["streak"]
-        if "min" in streak_req:
-            return user.current_streak >= streak_req["min"], min(1.0, user.current_streak / streak_req["min"])
-        return False, 0.0
-    
+        deps.uses_streak = True
+        return _compile_threshold(condition["streak"], lambda facts: facts.current_streak)
+
     elif "competence_area" in condition:
         area = condition["competence_area"]
         min_missions = condition.get("min_missions", 1)
-        
-        # Count completed missions in this competence area
-        area_missions = await db.missions.find({"competence_area": area}).to_list(100)
-        completed_in_area = len([m for m in area_missions if m["id"] in user.completed_missions])
-        
-        score = min(1.0, completed_in_area / min_missions) if min_missions > 0 else 0
-        return completed_in_area >= min_missions, score
-    
-    return False, 0.0
+        deps.competence_areas.add(area)
+
+        def evaluate_competence_area(facts: EligibilityFacts) -> tuple[bool, float]:
+            # Count completed missions in this competence area
+            completed_in_area = len([m for m in facts.area_missions.get(area, []) if m in facts.completed_missions])
+            score = min(1.0, completed_in_area / min_missions) if min_missions > 0 else 0
+            return completed_in_area >= min_missions, score
+        return evaluate_competence_area
+
+    return _never_met
+
+# Compiled rules keyed by rule id; an entry is reused only while its version and source match
+compiled_rule_cache: Dict[str, CompiledEligibilityRule] = {}
+
+def compile_eligibility_rule(rule: EligibilityRule) -> CompiledEligibilityRule:
+    """Return the cached compiled form of a rule, compiling it on first use"""
+    compiled = compiled_rule_cache.get(rule.id)
+    if compiled is None or compiled.version != rule.version or compiled.source != rule.condition:
+        compiled = CompiledEligibilityRule(rule)
+        compiled_rule_cache[rule.id] = compiled
+    return compiled
+
+async def get_compiled_event_rules(event_id: str) -> List[CompiledEligibilityRule]:
+    rules = await db.eligibility_rules.find({"event_id": event_id}, {"_id": 0}).to_list(100)
+    return [compile_eligibility_rule(EligibilityRule(**rule)) for rule in rules]
+
+async def load_area_missions(compiled_rules: List[CompiledEligibilityRule]) -> Dict[str, List[str]]:
+    """Mission ids per competence area referenced by the given rules"""
+    areas = set().union(*(compiled.competence_areas for compiled in compiled_rules))
+    if not areas:
+        return {}
+    catalog = await get_mission_catalog()
+    return {area: list(catalog.area_ids(area)) for area in areas if catalog.area_ids(area)}
+
+async def load_approved_documents(user_ids: List[str]) -> Dict[str, set]:
+    """Approved document types per user, for any number of users in one aggregation"""
+    pipeline = [
+        {"$match": {"user_id": {"$in": user_ids}, "status": "approved"}},
+        {"$group": {"_id": "$user_id", "document_types": {"$addToSet": "$document_type"}}}
+    ]
+    approved = {}
+    async for group in db.documents.aggregate(pipeline):
+        approved[group["_id"]] = set(group["document_types"])
+    return approved
+
+def build_eligibility_facts(
+    user: dict,
+    approved_documents: Optional[set] = None,
+    area_missions: Optional[Dict[str, List[str]]] = None
+) -> EligibilityFacts:
+    return EligibilityFacts(
+        points=user.get("points", 0),
+        current_streak=user.get("current_streak", 0),
+        completed_missions=user.get("completed_missions", []),
+        approved_documents=approved_documents,
+        area_missions=area_missions
+    )
 
-async def calculate_event_eligibility(user_id: str, event_id: str) -> EventEligibility:
-    """Calculate eligibility for a specific event"""
-    user = await db.users.find_one({"id": user_id})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_obj = User(**user)
-    
-    # Get event eligibility rules
-    rules = await db.eligibility_rules.find({"event_id": event_id}).to_list(100)
-    
-    if not rules:
+async def load_eligibility_facts(user: dict, compiled_rules: List[CompiledEligibilityRule]) -> EligibilityFacts:
+    """Fetch everything the given rules depend on for one user, once per dependency"""
+    approved_documents = set()
+    if any(compiled.needs_documents for compiled in compiled_rules):
+        approved_documents = (await load_approved_documents([user["id"]])).get(user["id"], set())
+    area_missions = await load_area_missions(compiled_rules)
+    return build_eligibility_facts(user, approved_documents, area_missions)
+
+def score_event_eligibility(
+    event_id: str,
+    user_id: str,
+    compiled_rules: List[CompiledEligibilityRule],
+    facts: EligibilityFacts
+) -> EventEligibility:
+    """Combine the weighted rule scores of one user into an EventEligibility"""
+    if not compiled_rules:
         # No rules defined, user is eligible
         return EventEligibility(
             event_id=event_id,
@@ -1516,9 +2120,9 @@ async def calculate_event_eligibility(user_id: str, event_id: str) -> EventEligi
     total_weight = 0.0
     missing_requirements = []
     
-    for rule in rules:
-        rule_obj = EligibilityRule(**rule)
-        is_met, score = await evaluate_eligibility_rule(user_obj, rule_obj.condition)
+    for compiled in compiled_rules:
+        rule_obj = compiled.rule
+        is_met, score = compiled.evaluate(facts)
         
         weighted_score = score * rule_obj.weight
         total_score += weighted_score
@@ -1550,20 +2154,502 @@ async def calculate_event_eligibility(user_id: str, event_id: str) -> EventEligi
         missing_requirements=missing_requirements
     )
 
+async def calculate_event_eligibility(user_id: str, event_id: str) -> EventEligibility:
+    """Calculate eligibility for a specific event"""
+    user = await db.users.find_one({"id": user_id}, ELIGIBILITY_USER_PROJECTION)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Get event eligibility rules
+    compiled_rules = await get_compiled_event_rules(event_id)
+    facts = await load_eligibility_facts(user, compiled_rules)
+    return score_event_eligibility(event_id, user_id, compiled_rules, facts)
+
+async def calculate_bulk_event_eligibility(event_id: str, user_query: Dict[str, Any]) -> Dict[str, Any]:
+    """Evaluate an event's rules for every user matching `user_query` in one pass.
+
+    Users are streamed with a projection in batches of ELIGIBILITY_BATCH_SIZE.
+    Each batch costs one documents aggregation (only when the rules need
+    documents) and one unordered bulk write to event_eligibilities. The bulk
+    write of a batch overlaps with reading the next one.
+    """
+    started = time.monotonic()
+    compiled_rules = await get_compiled_event_rules(event_id)
+    needs_documents = any(compiled.needs_documents for compiled in compiled_rules)
+    area_missions = await load_area_missions(compiled_rules)
+    
+    counts = {eligibility_status.value: 0 for eligibility_status in EligibilityStatus}
+    pending_write = None
+    
+    async def evaluate_batch(users: List[dict]):
+        approved_documents = {}
+        if needs_documents:
+            approved_documents = await load_approved_documents([user["id"] for user in users])
+        
+        operations = []
+        for user in users:
+            facts = build_eligibility_facts(user, approved_documents.get(user["id"], set()), area_missions)
+            eligibility = score_event_eligibility(event_id, user["id"], compiled_rules, facts)
+            counts[eligibility.status.value] += 1
+            # Bumping the revision keeps an in-flight incremental recompute,
+            # which read the older revision, from overwriting this result
+            operations.append(UpdateOne(
+                {"event_id": event_id, "user_id": user["id"]},
+                {"$set": {**eligibility.dict(), "stale": False}, "$inc": {"revision": 1}},
+                upsert=True
+            ))
+        return operations
+    
+    async def flush(users: List[dict]):
+        nonlocal pending_write
+        operations = await evaluate_batch(users)
+        if pending_write:
+            await pending_write
+        pending_write = asyncio.ensure_future(db.event_eligibilities.bulk_write(operations, ordered=False))
+    
+    batch = []
+    cursor = db.users.find(user_query, ELIGIBILITY_USER_PROJECTION).batch_size(ELIGIBILITY_BATCH_SIZE)
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) >= ELIGIBILITY_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    if pending_write:
+        await pending_write
+    
+    return {
+        "event_id": event_id,
+        "evaluated": sum(counts.values()),
+        "by_status": counts,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+    }
+
+# Incremental eligibility
+# event_eligibilities rows are the source of truth for reads. A state change
+# marks only the rows whose compiled rules reference what changed as stale
+# (bumping their revision) and recomputes them in the background. A
+# recompute only lands if the row's revision is still the one it read.
+ELIGIBILITY_RULES_REFRESH_SECONDS = int(os.environ.get("ELIGIBILITY_RULES_REFRESH_SECONDS", 60))
+
+class EligibilityChange:
+    """What changed in a user's state, in the vocabulary of compiled rule dependencies"""
+
+    def __init__(
+        self,
+        mission_ids: Optional[set] = None,
+        competence_areas: Optional[set] = None,
+        document_types: Optional[set] = None,
+        points: bool = False,
+        streak: bool = False
+    ):
+        self.mission_ids = mission_ids or set()
+        self.competence_areas = competence_areas or set()
+        self.document_types = document_types or set()
+        self.points = points
+        self.streak = streak
+
+    def affects(self, compiled: CompiledEligibilityRule) -> bool:
+        return bool(
+            (self.points and compiled.uses_points)
+            or (self.streak and compiled.uses_streak)
+            or self.mission_ids & compiled.mission_ids
+            or self.competence_areas & compiled.competence_areas
+            or self.document_types & compiled.document_types
+        )
+
+class EventRuleIndex:
+    """Compiled rules of every event, used to find the events a change can affect"""
+
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self.rules_by_event: Dict[str, List[CompiledEligibilityRule]] = {}
+        self.loaded_at = 0.0
+
+    async def affected_events(self, change: EligibilityChange) -> List[str]:
+        if time.monotonic() - self.loaded_at > self.refresh_seconds:
+            rules_by_event = {}
+            async for rule in db.eligibility_rules.find({}, {"_id": 0}):
+                compiled = compile_eligibility_rule(EligibilityRule(**rule))
+                rules_by_event.setdefault(compiled.rule.event_id, []).append(compiled)
+            self.rules_by_event = rules_by_event
+            self.loaded_at = time.monotonic()
+        return [
+            event_id for event_id, compiled_rules in self.rules_by_event.items()
+            if any(change.affects(compiled) for compiled in compiled_rules)
+        ]
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+event_rule_index = EventRuleIndex(ELIGIBILITY_RULES_REFRESH_SECONDS)
+
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-run
+background_tasks: set = set()
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def _revision_filter(revision: Optional[int]) -> Any:
+    # Rows written before revisions existed have no field at all
+    return revision if revision else {"$in": [None, 0]}
+
+async def store_event_eligibility(eligibility: EventEligibility, revision: Optional[int] = None, exists: bool = True):
+    """Write an eligibility row unless a newer state change bumped its revision meanwhile"""
+    query = {"event_id": eligibility.event_id, "user_id": eligibility.user_id}
+    if exists:
+        query["revision"] = _revision_filter(revision)
+    document = eligibility.dict()
+    document["revision"] = revision or 0
+    try:
+        await db.event_eligibilities.replace_one(query, document, upsert=True)
+    except DuplicateKeyError:
+        # The row changed after we read it; the newer recompute wins
+        pass
+
+async def get_event_eligibility_cached(user_id: str, event_id: str) -> EventEligibility:
+    """Read a user's eligibility row, recomputing it only when missing or stale"""
+    stored = await db.event_eligibilities.find_one({"event_id": event_id, "user_id": user_id}, {"_id": 0})
+    if stored and not stored.get("stale"):
+        return EventEligibility(**stored)
+    
+    eligibility = await calculate_event_eligibility(user_id, event_id)
+    await store_event_eligibility(eligibility, stored.get("revision") if stored else None, exists=stored is not None)
+    return eligibility
+
+async def recompute_user_eligibility(user_id: str, event_ids: List[str]):
+    """Recompute the stale rows of one user for the given events"""
+    rows = await db.event_eligibilities.find(
+        {"user_id": user_id, "event_id": {"$in": event_ids}, "stale": True},
+        {"_id": 0, "event_id": 1, "revision": 1}
+    ).to_list(len(event_ids))
+    for row in rows:
+        try:
+            eligibility = await calculate_event_eligibility(user_id, row["event_id"])
+        except HTTPException:
+            # User was deleted in the meantime
+            return
+        await store_event_eligibility(eligibility, row.get("revision"))
+
+async def invalidate_user_eligibility(user_id: str, change: EligibilityChange):
+    """Mark the user's rows affected by `change` as stale and recompute them in the background"""
+    event_ids = await event_rule_index.affected_events(change)
+    if not event_ids:
+        return
+    
+    result = await db.event_eligibilities.update_many(
+        {"user_id": user_id, "event_id": {"$in": event_ids}},
+        {"$set": {"stale": True}, "$inc": {"revision": 1}}
+    )
+    if result.modified_count:
+        spawn_background(recompute_user_eligibility(user_id, event_ids))
+
+async def invalidate_catalog_eligibility(change: EligibilityChange):
+    """Mark every user's rows affected by a mission catalog edit as stale; reads recompute them"""
+    event_ids = await event_rule_index.affected_events(change)
+    if event_ids:
+        await db.event_eligibilities.update_many(
+            {"event_id": {"$in": event_ids}},
+            {"$set": {"stale": True}, "$inc": {"revision": 1}}
+        )
+
+async def mark_legacy_eligibility_stale():
+    """Mark rows stored before revisions existed as stale, so reads recompute them once"""
+    result = await db.event_eligibilities.update_many(
+        {"revision": {"$exists": False}},
+        {"$set": {"stale": True, "revision": 0}}
+    )
+    if result.modified_count:
+        print(f"Marked {result.modified_count} legacy eligibility rows as stale")
+
+def mission_completion_change(mission: "Mission") -> EligibilityChange:
+    return EligibilityChange(
+        mission_ids={mission.id},
+        competence_areas={mission.competence_area.value},
+        points=True,
+        streak=True
+    )
+
+# Vectorized eligibility scoring
+# Whole-population scoring for dashboards. Users are loaded into a columnar
+# snapshot (points, streak, completed-missions and approved-documents
+# bitmaps) and the parsed rule conditions are evaluated as NumPy array
+# operations with the same semantics as the compiled per-user evaluators.
+USER_SNAPSHOT_TTL_SECONDS = int(os.environ.get("USER_SNAPSHOT_TTL_SECONDS", 60))
+SNAPSHOT_USER_PROJECTION = {**ELIGIBILITY_USER_PROJECTION, "completed_missions_bitmap": 1}
+
+class UserSnapshot:
+    """Columnar view of the users matching one query"""
+
+    def __init__(self, user_ids: List[str], points, current_streak, completed, mission_columns, approved, document_columns):
+        self.user_ids = user_ids
+        self.points = points
+        self.current_streak = current_streak
+        self.completed = completed
+        self.mission_columns = mission_columns
+        self.approved = approved
+        self.document_columns = document_columns
+        self.built_at = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.user_ids)
+
+    def count_completed(self, mission_ids: List[str]):
+        """Per-user number of the given missions completed (bitmap AND + popcount)"""
+        counts = np.zeros(self.size, dtype=np.int64)
+        for mission_id in mission_ids:
+            column = self.mission_columns.get(mission_id)
+            if column is not None:
+                counts += self.completed[:, column]
+        return counts
+
+    def count_approved(self, document_types: List[str]):
+        counts = np.zeros(self.size, dtype=np.int64)
+        for document_type in document_types:
+            column = self.document_columns.get(document_type)
+            if column is not None:
+                counts += self.approved[:, column]
+        return counts
+
+async def build_user_snapshot(user_query: Dict[str, Any]) -> UserSnapshot:
+    user_ids, points, streaks, rows, columns = [], [], [], [], []
+    # Catalog missions take the column of their bitmap ordinal, so stored
+    # bitmaps unpack straight into rows; other ids get columns after those
+    catalog = await get_mission_catalog()
+    mission_columns: Dict[str, int] = dict(catalog.ordinals) if catalog.bitmap_ready else {}
+    next_column = catalog.bitmap_width if catalog.bitmap_ready else 0
+    bitmap_rows, bitmaps = [], []
+    cursor = db.users.find(user_query, SNAPSHOT_USER_PROJECTION).batch_size(ELIGIBILITY_BATCH_SIZE)
+    async for user in cursor:
+        row = len(user_ids)
+        user_ids.append(user["id"])
+        points.append(user.get("points", 0))
+        streaks.append(user.get("current_streak", 0))
+        completed_missions = user.get("completed_missions", [])
+        bitmap = user.get("completed_missions_bitmap")
+        if bitmap and catalog.completed_mask(completed_missions, bitmap) is not None:
+            bitmap_rows.append(row)
+            bitmaps.append(bitmap)
+            continue
+        for mission_id in set(completed_missions):
+            if mission_id not in mission_columns:
+                mission_columns[mission_id] = next_column
+                next_column += 1
+            rows.append(row)
+            columns.append(mission_columns[mission_id])
+
+    completed = np.zeros((len(user_ids), next_column), dtype=bool)
+    completed[rows, columns] = True
+    for row, bitmap in zip(bitmap_rows, bitmaps):
+        bits = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), bitorder="little")[:next_column]
+        completed[row, :len(bits)] = bits
+
+    row_of = {user_id: row for row, user_id in enumerate(user_ids)}
+    document_columns = {document_type.value: i for i, document_type in enumerate(DocumentType)}
+    doc_rows, doc_columns = [], []
+    pipeline = [
+        {"$match": {"status": "approved"}},
+        {"$group": {"_id": "$user_id", "document_types": {"$addToSet": "$document_type"}}}
+    ]
+    async for group in db.documents.aggregate(pipeline):
+        row = row_of.get(group["_id"])
+        if row is None:
+            continue
+        for document_type in group["document_types"]:
+            doc_rows.append(row)
+            doc_columns.append(document_columns.setdefault(document_type, len(document_columns)))
+    approved = np.zeros((len(user_ids), len(document_columns)), dtype=bool)
+    approved[doc_rows, doc_columns] = True
+
+    return UserSnapshot(
+        user_ids,
+        np.array(points, dtype=np.int64),
+        np.array(streaks, dtype=np.int64),
+        completed,
+        mission_columns,
+        approved,
+        document_columns
+    )
+
+snapshot_cache: Dict[tuple, UserSnapshot] = {}
+
+async def get_user_snapshot(ciudad: Optional[str] = None, cohorte: Optional[str] = None) -> UserSnapshot:
+    key = (ciudad, cohorte)
+    snapshot = snapshot_cache.get(key)
+    if snapshot is None or time.monotonic() - snapshot.built_at > USER_SNAPSHOT_TTL_SECONDS:
+        query = {}
+        if ciudad:
+            query["ciudad"] = ciudad
+        if cohorte:
+            query["cohorte"] = cohorte
+        snapshot = await build_user_snapshot(query)
+        snapshot_cache[key] = snapshot
+    return snapshot
+
+def _vector_threshold(requirement, values):
+    if not isinstance(requirement, dict) or "min" not in requirement:
+        return None
+    minimum = requirement["min"]
+    score = np.minimum(1.0, values / minimum) if minimum else np.ones(len(values))
+    return values >= minimum, score
+
+def evaluate_condition_vector(condition: Any, snapshot: UserSnapshot, area_missions: Dict[str, List[str]]):
+    """Array counterpart of _compile_condition: returns (met, score) arrays over the snapshot"""
+    never = (np.zeros(snapshot.size, dtype=bool), np.zeros(snapshot.size))
+    if not isinstance(condition, dict):
+        return never
+
+    if "and" in condition or "or" in condition:
+        is_and = "and" in condition
+        sub_conditions = condition["and"] if is_and else condition["or"]
+        if not isinstance(sub_conditions, list):
+            return never
+        results = [evaluate_condition_vector(sub, snapshot, area_missions) for sub in sub_conditions]
+        if not results:
+            # all([]) is True, any([]) is False; both score 0
+            return np.full(snapshot.size, is_and), np.zeros(snapshot.size)
+        if is_and:
+            # Sequential sum keeps float results identical to the per-user evaluator
+            total = np.zeros(snapshot.size)
+            for _, score in results:
+                total = total + score
+            return np.logical_and.reduce([met for met, _ in results]), total / len(results)
+        return np.logical_or.reduce([met for met, _ in results]), np.maximum.reduce([score for _, score in results])
+
+    elif "missions" in condition or "documents" in condition:
+        is_missions = "missions" in condition
+        required = list((condition["missions"] if is_missions else condition["documents"]) or [])
+        if not required:
+            return never
+        counts = snapshot.count_completed(required) if is_missions else snapshot.count_approved(required)
+        score = counts / len(required)
+        return score == 1.0, score
+
+    elif "points" in condition or "xp" in condition:
+        requirement = condition["points"] if "points" in condition else condition["xp"]
+        return _vector_threshold(requirement, snapshot.points) or never
+
+    elif "streak" in condition:
+        return _vector_threshold(condition["streak"], snapshot.current_streak) or never
+
+    elif "competence_area" in condition:
+        min_missions = condition.get("min_missions", 1)
+        completed_in_area = snapshot.count_completed(area_missions.get(condition["competence_area"], []))
+        if min_missions > 0:
+            score = np.minimum(1.0, completed_in_area / min_missions)
+        else:
+            score = np.zeros(snapshot.size)
+        return completed_in_area >= min_missions, score
+
+    return never
+
+def score_snapshot_eligibility(
+    compiled_rules: List[CompiledEligibilityRule],
+    snapshot: UserSnapshot,
+    area_missions: Dict[str, List[str]]
+):
+    """Eligibility percentage and per-rule met flags for every user in the snapshot"""
+    if not compiled_rules:
+        return np.full(snapshot.size, 100.0), {}
+
+    total_score = np.zeros(snapshot.size)
+    total_weight = 0.0
+    rule_met = {}
+    for compiled in compiled_rules:
+        met, score = evaluate_condition_vector(compiled.condition, snapshot, area_missions)
+        total_score = total_score + score * compiled.rule.weight
+        total_weight += compiled.rule.weight
+        rule_met[compiled.rule.rule_name] = met
+
+    if total_weight <= 0:
+        return np.zeros(snapshot.size), rule_met
+    return total_score / total_weight * 100, rule_met
+
+async def calculate_eligibility_histogram(event_id: str, ciudad: Optional[str] = None, cohorte: Optional[str] = None) -> Dict[str, Any]:
+    started = time.monotonic()
+    compiled_rules = await get_compiled_event_rules(event_id)
+    area_missions = await load_area_missions(compiled_rules)
+    snapshot = await get_user_snapshot(ciudad, cohorte)
+    percentages, rule_met = score_snapshot_eligibility(compiled_rules, snapshot, area_missions)
+
+    eligible = percentages >= 100
+    partial = (percentages >= 50) & ~eligible
+    bin_counts, bin_edges = np.histogram(np.clip(percentages, 0, 100), bins=10, range=(0, 100))
+
+    return {
+        "event_id": event_id,
+        "total_users": snapshot.size,
+        "by_status": {
+            EligibilityStatus.ELIGIBLE.value: int(eligible.sum()),
+            EligibilityStatus.PARTIAL.value: int(partial.sum()),
+            EligibilityStatus.NOT_ELIGIBLE.value: int(snapshot.size - eligible.sum() - partial.sum())
+        },
+        "histogram": [
+            {"from": float(bin_edges[i]), "to": float(bin_edges[i + 1]), "users": int(count)}
+            for i, count in enumerate(bin_counts)
+        ],
+        "average_percentage": float(percentages.mean()) if snapshot.size else 0.0,
+        "rules_met": {rule_name: int(met.sum()) for rule_name, met in rule_met.items()},
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+    }
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def create_signed_qr_token(user_id: str, event_id: Optional[str], status: EligibilityStatus, expires_at: datetime) -> str:
+    """Compact HMAC-signed token: v1.<payload>.<signature>"""
+    payload = json.dumps({
+        "u": user_id,
+        "e": event_id,
+        "s": status.value,
+        "x": int((expires_at - UNIX_EPOCH).total_seconds()),
+        "n": secrets.token_urlsafe(9)
+    }, separators=(",", ":")).encode()
+    body = _b64encode(payload)
+    signature = hmac.new(QR_TOKEN_SECRET, body.encode(), hashlib.sha256).digest()[:16]
+    return f"{SIGNED_QR_TOKEN_PREFIX}{body}.{_b64encode(signature)}"
+
+def decode_signed_qr_token(token: str) -> Optional[Dict[str, Any]]:
+    """Return the token payload if the signature is valid, None otherwise"""
+    try:
+        body, signature = token[len(SIGNED_QR_TOKEN_PREFIX):].split(".")
+        expected = hmac.new(QR_TOKEN_SECRET, body.encode(), hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return None
+        return json.loads(_b64decode(body))
+    except (ValueError, TypeError):
+        return None
+
+def is_signed_qr_token(token: str) -> bool:
+    return token.startswith(SIGNED_QR_TOKEN_PREFIX)
+
 async def generate_qr_token(user_id: str, event_id: Optional[str] = None) -> QRToken:
     """Generate QR token for user eligibility status"""
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, QR_USER_INFO_PROJECTION)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Calculate eligibility if event specified
     eligibility_status = EligibilityStatus.ELIGIBLE
     if event_id:
-        eligibility = await calculate_event_eligibility(user_id, event_id)
+        eligibility = await get_event_eligibility_cached(user_id, event_id)
         eligibility_status = eligibility.status
     
+    expires_at = datetime.utcnow() + timedelta(minutes=QR_TOKEN_TTL_MINUTES)
+    
     # Generate secure token
-    token = secrets.token_urlsafe(32)
+    if QR_STATELESS_TOKENS:
+        token = create_signed_qr_token(user_id, event_id, eligibility_status, expires_at)
+    else:
+        token = secrets.token_urlsafe(32)
     
     # Create QR token
     qr_token = QRToken(
@@ -1571,297 +2657,1620 @@ async def generate_qr_token(user_id: str, event_id: Optional[str] = None) -> QRT
         event_id=event_id,
         token=token,
         status=eligibility_status,
-        user_info={
-            "name": f"{user['nombre']} {user['apellido']}",
-            "cedula": user['cedula'],
-            "emprendimiento": user['nombre_emprendimiento'],
-            "points": user['points'],
-            "rank": user['rank']
-        },
-        expires_at=datetime.utcnow() + timedelta(minutes=5)  # 5 minute expiry
+        user_info=qr_user_info(user),
+        expires_at=expires_at
     )
     
-    await db.qr_tokens.insert_one(qr_token.dict())
+    if not QR_STATELESS_TOKENS:
+        await db.qr_tokens.insert_one(qr_token.dict())
     return qr_token
 
+QR_USER_INFO_PROJECTION = {"_id": 0, "id": 1, "nombre": 1, "apellido": 1, "cedula": 1, "nombre_emprendimiento": 1, "points": 1, "rank": 1}
+
+def qr_user_info(user: dict) -> Dict[str, Any]:
+    return {
+        "name": f"{user['nombre']} {user['apellido']}",
+        "cedula": user['cedula'],
+        "emprendimiento": user['nombre_emprendimiento'],
+        "points": user['points'],
+        "rank": user['rank']
+    }
+
+def to_naive_utc(value: datetime) -> datetime:
+    """Mongo stores naive UTC datetimes; normalize client-supplied aware ones"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _claim_conflict_filter(scanned_at: datetime, device_id: Optional[str], used_at_field: str, device_field: str) -> List[dict]:
+    """Offline conflicts resolve to the earliest scan, ties to the lowest device id"""
+    return [
+        {used_at_field: {"$gt": scanned_at}},
+        {used_at_field: scanned_at, device_field: {"$gt": device_id}}
+    ]
+
+def offline_sync_window_closed(expires_at: datetime) -> bool:
+    """Whether it is too late to sync offline scans of a token that expired at expires_at.
+
+    Past this point the single-use marker of a signed token may already be
+    gone, so accepting a backdated scan could let a used token in twice.
+    """
+    return datetime.utcnow() > expires_at + timedelta(hours=QR_OFFLINE_SYNC_WINDOW_HOURS)
+
+async def claim_stored_qr_token(token: str, scanned_at: datetime, device_id: Optional[str], offline: bool) -> Dict[str, Any]:
+    query = {"token": token, "expires_at": {"$gte": scanned_at}}
+    if offline:
+        window_start = datetime.utcnow() - timedelta(hours=QR_OFFLINE_SYNC_WINDOW_HOURS)
+        query["expires_at"] = {"$gte": max(scanned_at, window_start)}
+        query["$or"] = [{"used": False}] + _claim_conflict_filter(scanned_at, device_id, "used_at", "used_by_device")
+    else:
+        query["used"] = False
+    
+    # Checking and claiming in one conditional write: two scanners cannot both accept a token
+    qr_token = await db.qr_tokens.find_one_and_update(
+        query,
+        {"$set": {"used": True, "used_at": scanned_at, "used_by_device": device_id}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if qr_token:
+        return {
+            "token": token,
+            "valid": True,
+            "user_id": qr_token["user_id"],
+            "user_info": qr_token["user_info"],
+            "status": qr_token["status"],
+            "event_id": qr_token.get("event_id")
+        }
+    
+    qr_token = await db.qr_tokens.find_one({"token": token}, {"_id": 0, "expires_at": 1, "used_at": 1, "used_by_device": 1})
+    if not qr_token:
+        return {"token": token, "valid": False, "reason": "invalid"}
+    if offline and offline_sync_window_closed(qr_token["expires_at"]):
+        return {"token": token, "valid": False, "reason": "sync_window_closed"}
+    if scanned_at > qr_token["expires_at"]:
+        return {"token": token, "valid": False, "reason": "expired"}
+    return {
+        "token": token,
+        "valid": False,
+        "reason": "already_used",
+        "used_at": qr_token.get("used_at"),
+        "used_by_device": qr_token.get("used_by_device")
+    }
+
+async def claim_signed_qr_token(token: str, scanned_at: datetime, device_id: Optional[str], offline: bool) -> Dict[str, Any]:
+    """Verify a signed token and claim it; the only write is the single-use marker"""
+    payload = decode_signed_qr_token(token)
+    if payload is None:
+        return {"token": token, "valid": False, "reason": "invalid"}
+    
+    expires_at = UNIX_EPOCH + timedelta(seconds=payload["x"])
+    if offline and offline_sync_window_closed(expires_at):
+        return {"token": token, "valid": False, "reason": "sync_window_closed"}
+    if scanned_at > expires_at:
+        return {"token": token, "valid": False, "reason": "expired"}
+    
+    marker = {
+        "id": payload["n"],
+        "user_id": payload["u"],
+        "event_id": payload["e"],
+        "used_at": scanned_at,
+        "device_id": device_id,
+        # Kept past the token's expiry so late offline syncs still resolve against it
+        "expires_at": expires_at + timedelta(hours=QR_OFFLINE_SYNC_WINDOW_HOURS)
+    }
+    try:
+        if offline:
+            await db.qr_token_uses.update_one(
+                {"id": payload["n"], "$or": _claim_conflict_filter(scanned_at, device_id, "used_at", "device_id")},
+                {"$set": marker},
+                upsert=True
+            )
+        else:
+            await db.qr_token_uses.insert_one(marker)
+    except DuplicateKeyError:
+        existing = await db.qr_token_uses.find_one({"id": payload["n"]}, {"_id": 0, "used_at": 1, "device_id": 1})
+        return {
+            "token": token,
+            "valid": False,
+            "reason": "already_used",
+            "used_at": existing.get("used_at") if existing else None,
+            "used_by_device": existing.get("device_id") if existing else None
+        }
+    
+    return {
+        "token": token,
+        "valid": True,
+        "user_id": payload["u"],
+        "status": EligibilityStatus(payload["s"]),
+        "event_id": payload["e"]
+    }
+
+async def claim_qr_tokens(scans: List["QRScan"], device_id: Optional[str] = None, offline: bool = False) -> List[Dict[str, Any]]:
+    """Atomically claim a batch of tokens and return one result per scan, in order"""
+    now = datetime.utcnow()
+    
+    async def claim(scan: "QRScan") -> Dict[str, Any]:
+        # Device clocks may run ahead; never accept a scan from the future
+        scanned_at = min(to_naive_utc(scan.scanned_at), now) if offline and scan.scanned_at else now
+        if is_signed_qr_token(scan.token):
+            return await claim_signed_qr_token(scan.token, scanned_at, device_id, offline)
+        return await claim_stored_qr_token(scan.token, scanned_at, device_id, offline)
+    
+    results = await asyncio.gather(*(claim(scan) for scan in scans))
+    
+    # Signed tokens carry no user info; load it for all accepted ones at once
+    user_ids = {result["user_id"] for result in results if result["valid"] and "user_info" not in result}
+    if user_ids:
+        users = await db.users.find({"id": {"$in": list(user_ids)}}, QR_USER_INFO_PROJECTION).to_list(len(user_ids))
+        users_by_id = {user["id"]: user for user in users}
+        for result in results:
+            if result["valid"] and "user_info" not in result:
+                user = users_by_id.get(result["user_id"])
+                result["user_info"] = qr_user_info(user) if user else None
+    return results
+
+def _requirement_leaves(condition: Any, facts: EligibilityFacts, compiled: CompiledEligibilityRule) -> List[dict]:
+    """Flatten and/or groups into the leaf requirements a user can still act on.
+
+    Groups the user already meets contribute nothing, so an "or" satisfied
+    by one branch doesn't suggest the leaves of the others.
+    """
+    if not isinstance(condition, dict):
+        return []
+    for group_key in ("and", "or"):
+        if group_key in condition:
+            is_met, _ = compiled.group_evaluators.get(id(condition), _never_met)(facts)
+            if is_met:
+                return []
+            sub_conditions = condition[group_key] if isinstance(condition[group_key], list) else []
+            return [leaf for sub_condition in sub_conditions for leaf in _requirement_leaves(sub_condition, facts, compiled)]
+    return [condition]
+
 async def generate_suggestions_for_event(user_id: str, event_id: str) -> List[Dict[str, Any]]:
-    """Generate smart suggestions for what user needs to be eligible for event"""
-    user = await db.users.find_one({"id": user_id})
+    """Generate smart suggestions for what user needs to be eligible for event, quickest first"""
+    user = await db.users.find_one({"id": user_id}, ELIGIBILITY_USER_PROJECTION)
     if not user:
         return []
     
-    eligibility = await calculate_event_eligibility(user_id, event_id)
-    suggestions = []
+    # Evaluate once and reuse the fetched facts (approved documents, area missions) below
+    compiled_rules = await get_compiled_event_rules(event_id)
+    facts = await load_eligibility_facts(user, compiled_rules)
     
-    for missing in eligibility.missing_requirements:
-        try:
-            condition = json.loads(missing["condition"])
-            
-            if "missions" in condition:
-                required_missions = condition["missions"]
-                incomplete_missions = [m for m in required_missions if m not in user["completed_missions"]]
-                
-                for mission_id in incomplete_missions:
-                    mission = await db.missions.find_one({"id": mission_id})
-                    if mission:
-                        suggestions.append({
-                            "type": "mission",
-                            "id": mission_id,
-                            "title": mission["title"],
-                            "description": f"Completa esta misión para cumplir: {missing['rule_name']}",
-                            "competence_area": mission["competence_area"],
-                            "points_reward": mission["points_reward"],
-                            "estimated_time": mission["estimated_time"],
-                            "priority": "high" if missing["completion_percentage"] < 25 else "medium"
-                        })
-            
-            elif "documents" in condition:
-                required_docs = condition["documents"]
-                user_docs = await db.documents.find({"user_id": user_id, "status": "approved"}).to_list(100)
-                approved_doc_types = [doc["document_type"] for doc in user_docs]
-                
-                missing_docs = [doc for doc in required_docs if doc not in approved_doc_types]
-                
-                for doc_type in missing_docs:
-                    suggestions.append({
-                        "type": "document",
-                        "document_type": doc_type,
-                        "title": f"Sube tu {doc_type.replace('_', ' ').title()}",
-                        "description": f"Documento requerido para: {missing['rule_name']}",
-                        "priority": "high"
-                    })
-            
-            elif "points" in condition:
-                points_needed = condition["points"]["min"] - user["points"]
-                if points_needed > 0:
-                    suggestions.append({
-                        "type": "points",
-                        "points_needed": points_needed,
-                        "title": f"Gana {points_needed} puntos más",
-                        "description": f"Completa más misiones para obtener los puntos necesarios",
-                        "priority": "medium"
-                    })
-                    
-        except json.JSONDecodeError:
+    mission_requirements: Dict[str, tuple[str, float]] = {}
+    document_requirements: Dict[str, str] = {}
+    points_requirement = None
+    
+    for compiled in compiled_rules:
+        is_met, score = compiled.evaluate(facts)
+        if is_met:
             continue
+        rule_name = compiled.rule.rule_name
+        for leaf in _requirement_leaves(compiled.condition, facts, compiled):
+            if "missions" in leaf:
+                for mission_id in leaf["missions"] or []:
+                    if mission_id not in facts.completed_missions:
+                        mission_requirements.setdefault(mission_id, (rule_name, score * 100))
+            elif "documents" in leaf:
+                for doc_type in leaf["documents"] or []:
+                    if doc_type not in facts.approved_documents:
+                        document_requirements.setdefault(doc_type, rule_name)
+            elif "points" in leaf and isinstance(leaf["points"], dict) and "min" in leaf["points"]:
+                points_needed = leaf["points"]["min"] - facts.points
+                if points_needed > 0 and (points_requirement is None or points_needed > points_requirement):
+                    points_requirement = points_needed
     
-    return suggestions
-
-# Enhanced utility functions
-async def calculate_user_level(points: int) -> tuple[UserLevel, int]:
-    """Calculate user level based on points and return (level, points_in_level)"""
-    levels = [
-        (UserLevel.NOVATO, 0),
-        (UserLevel.PRINCIPIANTE, 100),
-        (UserLevel.INTERMEDIO, 300),
-        (UserLevel.AVANZADO, 600),
-        (UserLevel.EXPERTO, 1000),
-        (UserLevel.MAESTRO, 1500),
-        (UserLevel.LEYENDA, 2500)
-    ]
+    suggestions = []
     
-    current_level = UserLevel.NOVATO
-    level_points = points
+    catalog = await get_mission_catalog()
+    for mission_id, (rule_name, completion_percentage) in mission_requirements.items():
+        mission = catalog.by_id.get(mission_id)
+        if not mission:
+            continue
+        suggestions.append({
+            "type": "mission",
+            "id": mission.id,
+            "title": mission.title,
+            "description": f"Completa esta misión para cumplir: {rule_name}",
+            "competence_area": mission.competence_area,
+            "points_reward": mission.points_reward,
+            "estimated_time": mission.estimated_time,
+            "estimated_minutes": mission.estimated_time,
+            "priority": "high" if completion_percentage < 25 else "medium"
+        })
     
-    for level, threshold in reversed(levels):
-        if points >= threshold:
-            current_level = level
-            level_points = points - threshold
-            break
+    for doc_type, rule_name in document_requirements.items():
+        suggestions.append({
+            "type": "document",
+            "document_type": doc_type,
+            "title": f"Sube tu {doc_type.replace('_', ' ').title()}",
+            "description": f"Documento requerido para: {rule_name}",
+            "estimated_minutes": DOCUMENT_SUGGESTION_ESTIMATED_MINUTES,
+            "priority": "high"
+        })
     
-    return current_level, level_points
+    if points_requirement:
+        # Estimate from the points-per-minute rate of the missions still open to the user
+        open_missions = [mission for mission in catalog.missions if mission.id not in facts.completed_missions]
+        open_minutes = sum(mission.estimated_time for mission in open_missions)
+        points_per_minute = sum(mission.points_reward for mission in open_missions) / open_minutes if open_minutes else 0
+        suggestions.append({
+            "type": "points",
+            "points_needed": points_requirement,
+            "title": f"Gana {points_requirement} puntos más",
+            "description": f"Completa más misiones para obtener los puntos necesarios",
+            "estimated_minutes": round(points_requirement / points_per_minute) if points_per_minute else None,
+            "priority": "medium"
+        })
+    
+    # Rank by estimated time-to-eligibility; unknown estimates go last
+    suggestions.sort(key=lambda suggestion: (suggestion["estimated_minutes"] is None, suggestion["estimated_minutes"] or 0))
+    return suggestions
+
+# Mission catalog
+# Missions change only through the admin routes, so every reader in the
+# process shares one in-memory snapshot. A write bumps the version counter in
+# catalog_state and drops the local snapshot; other worker processes learn
+# about it from a change stream on missions or, on servers without change
+# streams (standalone mongod), by polling the version counter.
+MISSION_CATALOG_POLL_SECONDS = int(os.environ.get("MISSION_CATALOG_POLL_SECONDS", 5))
+MISSION_CATALOG_STATE_ID = "missions"
+MISSION_ORDINALS_STATE_ID = "mission_ordinals"
+
+def encode_mission_bitmap(mask: int) -> bytes:
+    return mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+
+def decode_mission_bitmap(data: Optional[bytes]) -> int:
+    return int.from_bytes(data, "little") if data else 0
+
+class MissionCatalog:
+    """All missions ordered by position, with id, area and type lookups"""
+
+    def __init__(self, missions: List[dict], version: int = 0):
+        self.version = version
+        self.missions = sorted((Mission(**mission) for mission in missions), key=lambda m: m.position)
+        self.by_id: Dict[str, Mission] = {mission.id: mission for mission in self.missions}
+        ids_by_area: Dict[str, set] = {}
+        ids_by_type: Dict[str, set] = {}
+        for mission in self.missions:
+            ids_by_area.setdefault(mission.competence_area.value, set()).add(mission.id)
+            ids_by_type.setdefault(mission.type.value, set()).add(mission.id)
+        self.ids_by_area = {area: frozenset(ids) for area, ids in ids_by_area.items()}
+        self.ids_by_type = {mission_type: frozenset(ids) for mission_type, ids in ids_by_type.items()}
+        
+        # Bitmap layout: ordinals are dense, persisted and never reused
+        self.ordinals = {mission.id: mission.ordinal for mission in self.missions if mission.ordinal is not None}
+        self.bitmap_ready = len(self.ordinals) == len(self.missions)
+        self.bitmap_width = max(self.ordinals.values(), default=-1) + 1
+        self.known_mask = self.bitmap_of(self.ordinals)
+        self.area_masks = {area: self.bitmap_of(ids) for area, ids in self.ids_by_area.items()}
+        self.type_masks = {mission_type: self.bitmap_of(ids) for mission_type, ids in self.ids_by_type.items()}
+        
+        # Prerequisite graph: edges run from a prerequisite to the missions it gates
+        self.prerequisites: Dict[str, frozenset] = {
+            mission.id: frozenset(mission.prerequisite_missions) for mission in self.missions
+        }
+        dependents: Dict[str, set] = {}
+        for mission_id, prerequisites in self.prerequisites.items():
+            for prerequisite in prerequisites:
+                dependents.setdefault(prerequisite, set()).add(mission_id)
+        self.dependents = {mission_id: frozenset(ids) for mission_id, ids in dependents.items()}
+        self.topological_order = self._topological_order()
+        # Missions on a cycle can never be unlocked; writes reject new cycles
+        self.cyclic = frozenset(self.by_id) - frozenset(self.topological_order)
+
+    def _topological_order(self) -> List[str]:
+        """Kahn's algorithm over known missions, starting from position order"""
+        pending = {
+            mission.id: len(self.prerequisites[mission.id] & self.by_id.keys()) for mission in self.missions
+        }
+        ready = [mission.id for mission in self.missions if pending[mission.id] == 0]
+        order = []
+        while ready:
+            mission_id = ready.pop(0)
+            order.append(mission_id)
+            for dependent in sorted(self.dependents.get(mission_id, ()), key=lambda m: self.by_id[m].position):
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        return order
+
+    def descendants(self, mission_id: str) -> set:
+        """Every mission that transitively requires mission_id"""
+        seen = set()
+        stack = [mission_id]
+        while stack:
+            for dependent in self.dependents.get(stack.pop(), ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    stack.append(dependent)
+        return seen
+
+    def prerequisites_met(self, mission_id: str, completed: set) -> bool:
+        return self.prerequisites.get(mission_id, frozenset()) <= completed
+
+    def newly_unlocked(self, mission_id: str, completed: set) -> List[Mission]:
+        """Missions that completing mission_id just made available, given the completed set after it"""
+        return [
+            self.by_id[dependent] for dependent in self.dependents.get(mission_id, ())
+            if dependent not in completed and self.prerequisites[dependent] <= completed
+        ]
+
+    def bitmap_of(self, mission_ids) -> int:
+        """Bitmap of the given missions; ids without an ordinal (e.g. deleted missions) are left out"""
+        mask = 0
+        for mission_id in mission_ids:
+            ordinal = self.ordinals.get(mission_id)
+            if ordinal is not None:
+                mask |= 1 << ordinal
+        return mask
+
+    def completed_mask(self, completed_missions: List[str], bitmap: Optional[bytes]) -> Optional[int]:
+        """A user's stored bitmap, or None when it cannot stand in for the list.
+
+        The bitmap is trusted only when every mission has an ordinal, its
+        popcount matches the list length and it has no bits of missions that
+        were since deleted; a completion the outbox worker has not folded in
+        yet sends the caller back to the list.
+        """
+        if not self.bitmap_ready:
+            return None
+        mask = decode_mission_bitmap(bitmap)
+        if mask.bit_count() != len(completed_missions) or mask & ~self.known_mask:
+            return None
+        return mask
+
+    def area_ids(self, area: str) -> frozenset:
+        return self.ids_by_area.get(area, frozenset())
+
+    def type_ids(self, mission_type: str) -> frozenset:
+        return self.ids_by_type.get(mission_type, frozenset())
+
+    def in_area(self, area: str) -> List[Mission]:
+        return [mission for mission in self.missions if mission.competence_area.value == area]
+
+    def of_type(self, mission_type: str) -> List[Mission]:
+        return [mission for mission in self.missions if mission.type.value == mission_type]
+
+class MissionCatalogCache:
+    """Process-wide catalog snapshot, reloaded lazily after any mission write"""
+
+    def __init__(self, poll_seconds: int):
+        self.poll_seconds = poll_seconds
+        self.catalog: Optional[MissionCatalog] = None
+        # Bumped on every invalidation so a reload that raced with one is discarded
+        self.generation = 0
+        self.lock = asyncio.Lock()
+        self.mode = "starting"
+        self.reloads = 0
+
+    async def get(self) -> MissionCatalog:
+        catalog = self.catalog
+        if catalog is not None:
+            return catalog
+        async with self.lock:
+            while self.catalog is None:
+                generation = self.generation
+                # Version first: a write landing during the load leaves the snapshot behind the counter
+                state = await db.catalog_state.find_one({"id": MISSION_CATALOG_STATE_ID}, {"_id": 0, "version": 1})
+                missions = await db.missions.find({}, {"_id": 0}).to_list(None)
+                if generation == self.generation:
+                    self.catalog = MissionCatalog(missions, state["version"] if state else 0)
+                    self.reloads += 1
+                    if self.catalog.cyclic:
+                        print(f"Missions with cyclic prerequisites can never unlock: {', '.join(sorted(self.catalog.cyclic))}")
+            return self.catalog
+
+    def invalidate(self):
+        self.generation += 1
+        self.catalog = None
+
+    async def refresh(self) -> MissionCatalog:
+        """Catalog reloaded from MongoDB, for checks that must not see a stale snapshot"""
+        self.invalidate()
+        return await self.get()
+
+    async def changed(self, eligibility_change: Optional[EligibilityChange] = None):
+        """Record a mission write for every worker process.
+
+        `eligibility_change` names the missions and areas the write touched,
+        so stored eligibility rows whose rules reference them go stale.
+        """
+        await db.catalog_state.update_one(
+            {"id": MISSION_CATALOG_STATE_ID},
+            {"$inc": {"version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        self.invalidate()
+        if eligibility_change:
+            await invalidate_catalog_eligibility(eligibility_change)
+
+    async def watch(self):
+        """Follow mission writes made by other processes"""
+        while True:
+            try:
+                async with db.missions.watch() as stream:
+                    self.mode = "change_stream"
+                    # Writes made while no stream was open
+                    self.invalidate()
+                    async for _ in stream:
+                        self.invalidate()
+            except OperationFailure as e:
+                print(f"Mission change stream unavailable ({e}), polling catalog version")
+                self.mode = "polling"
+                await self.poll()
+                return
+            except Exception as e:
+                print(f"Mission change stream closed: {e}")
+                await asyncio.sleep(self.poll_seconds)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                state = await db.catalog_state.find_one({"id": MISSION_CATALOG_STATE_ID}, {"_id": 0, "version": 1})
+            except Exception as e:
+                print(f"Mission catalog poll failed: {e}")
+                continue
+            catalog = self.catalog
+            if catalog is not None and catalog.version != (state["version"] if state else 0):
+                self.invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "version": self.catalog.version if self.catalog else None,
+            "missions": len(self.catalog.missions) if self.catalog else None,
+            "cyclic_missions": sorted(self.catalog.cyclic) if self.catalog else None,
+            "reloads": self.reloads
+        }
+
+mission_catalog_cache = MissionCatalogCache(MISSION_CATALOG_POLL_SECONDS)
+
+async def next_mission_ordinal() -> int:
+    state = await db.catalog_state.find_one_and_update(
+        {"id": MISSION_ORDINALS_STATE_ID},
+        {"$inc": {"next": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return state["next"] - 1
+
+async def assign_mission_ordinals():
+    """Give missions stored before ordinals existed their ordinal, in position order"""
+    assigned = 0
+    async for mission in db.missions.find({"ordinal": None}, {"_id": 0, "id": 1}).sort("position", 1):
+        result = await db.missions.update_one(
+            {"id": mission["id"], "ordinal": None}, {"$set": {"ordinal": await next_mission_ordinal()}}
+        )
+        assigned += result.modified_count
+    if assigned:
+        print(f"Assigned ordinals to {assigned} missions")
+        await mission_catalog_cache.changed()
+
+async def store_completed_bitmap(user: dict, catalog: MissionCatalog):
+    """Write the bitmap of a user's completed missions, unless the list changed since it was read"""
+    if not catalog.bitmap_ready:
+        return
+    completed_missions = user.get("completed_missions", [])
+    result = await db.users.update_one(
+        {"id": user["id"], "completed_missions": {"$size": len(completed_missions)}},
+        {"$set": {"completed_missions_bitmap": encode_mission_bitmap(catalog.bitmap_of(completed_missions))}}
+    )
+    if result.modified_count:
+        invalidate_cached_user(user["id"])
+
+BITMAP_BACKFILL_BATCH_SIZE = 1000
+
+async def backfill_completed_bitmaps():
+    """Build bitmaps for users who completed missions before bitmaps existed"""
+    catalog = await get_mission_catalog()
+    if not catalog.bitmap_ready:
+        return
+    written = 0
+    batch = []
+    cursor = db.users.find(
+        {"completed_missions_bitmap": {"$exists": False}, "completed_missions.0": {"$exists": True}},
+        {"_id": 0, "id": 1, "completed_missions": 1}
+    ).batch_size(BITMAP_BACKFILL_BATCH_SIZE)
+    async for user in cursor:
+        completed_missions = user["completed_missions"]
+        batch.append(UpdateOne(
+            {"id": user["id"], "completed_missions": {"$size": len(completed_missions)}},
+            {"$set": {"completed_missions_bitmap": encode_mission_bitmap(catalog.bitmap_of(completed_missions))}}
+        ))
+        if len(batch) >= BITMAP_BACKFILL_BATCH_SIZE:
+            written += (await db.users.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        written += (await db.users.bulk_write(batch, ordered=False)).modified_count
+    if written:
+        user_principal_cache.clear()
+        print(f"Backfilled completed-missions bitmaps for {written} users")
+
+async def validate_prerequisites(mission_id: Optional[str], prerequisites: List[str]):
+    """Reject unknown prerequisites and any that would close a cycle through mission_id"""
+    if not prerequisites:
+        return
+    catalog = await mission_catalog_cache.refresh()
+    unknown = [prerequisite for prerequisite in prerequisites if prerequisite not in catalog.by_id]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown prerequisite missions: {', '.join(unknown)}")
+    if mission_id:
+        # A new edge prerequisite -> mission closes a cycle if the prerequisite already depends on the mission
+        cyclic = [
+            prerequisite for prerequisite in prerequisites
+            if prerequisite == mission_id or prerequisite in catalog.descendants(mission_id)
+        ]
+        if cyclic:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Prerequisites would create a cycle: {', '.join(cyclic)} already depend on this mission"
+            )
+
+async def get_mission_catalog() -> MissionCatalog:
+    """Shared mission catalog"""
+    return await mission_catalog_cache.get()
+
+# Badge rules
+# A badge condition is compiled into a predicate (metric, comparator,
+# threshold, scope). Besides the generic "metric[:scope] op threshold" form
+# (e.g. "points >= 750", "area_missions:marketing >= all") the historic
+# condition names are still understood. Predicates read only the user
+# document and the mission catalog.
+BADGE_RULES_REFRESH_SECONDS = int(os.environ.get("BADGE_RULES_REFRESH_SECONDS", 300))
+BADGE_SUBJECT_PROJECTION = {
+    "_id": 0, "id": 1, "points": 1, "current_streak": 1, "completed_missions": 1, "completed_missions_bitmap": 1
+}
+
+BADGE_COMPARATORS = {
+    ">=": lambda value, target: value >= target,
+    ">": lambda value, target: value > target,
+    "==": lambda value, target: value == target,
+    "<=": lambda value, target: value <= target,
+}
+
+# Metrics with a scope count the completed missions inside it
+SCOPED_BADGE_METRICS = {"area_missions", "type_missions"}
+BADGE_METRICS = {"missions_completed", "points", "streak"} | SCOPED_BADGE_METRICS
+
+LEGACY_BADGE_CONDITIONS = {
+    "complete_first_mission": ("missions_completed", ">=", 1, None),
+    "complete_legal_area": ("area_missions", ">=", "all", "legal"),
+    "complete_sales_area": ("area_missions", ">=", "all", "ventas"),
+    "network_builder": ("type_missions", ">=", 2, "networking_task"),
+}
+
+LEGACY_BADGE_PATTERNS = [
+    (re.compile(r"^complete_(\d+)_missions$"), "missions_completed"),
+    (re.compile(r"^streak_(\d+)_days$"), "streak"),
+    (re.compile(r"^earn_(\d+)_points$"), "points"),
+]
+
+BADGE_CONDITION_PATTERN = re.compile(
+    r"^(?P<metric>[a-z_]+)(?::(?P<scope>[a-z_]+))?\s*(?P<comparator>>=|<=|==|>)\s*(?P<threshold>\d+|all)$"
+)
 
-async def check_badge_eligibility(user: User, badge: Badge) -> bool:
-    """Check if user is eligible for a badge"""
-    condition = badge.condition
-    
-    # Achievement badges
-    if condition == "complete_first_mission":
-        return len(user.completed_missions) >= 1
-    elif condition == "complete_5_missions":
-        return len(user.completed_missions) >= 5
-    elif condition == "complete_10_missions":
-        return len(user.completed_missions) >= 10
-    elif condition == "complete_25_missions":
-        return len(user.completed_missions) >= 25
-    
-    # Streak badges
-    elif condition == "streak_3_days":
-        return user.current_streak >= 3
-    elif condition == "streak_7_days":
-        return user.current_streak >= 7
-    elif condition == "streak_14_days":
-        return user.current_streak >= 14
-    elif condition == "streak_30_days":
-        return user.current_streak >= 30
-    
-    # Skill badges (points)
-    elif condition == "earn_100_points":
-        return user.points >= 100
-    elif condition == "earn_500_points":
-        return user.points >= 500
-    elif condition == "earn_1000_points":
-        return user.points >= 1000
-    elif condition == "earn_2500_points":
-        return user.points >= 2500
-    
-    # Competence area badges
-    elif condition == "complete_legal_area":
-        legal_missions = await db.missions.find({"competence_area": "legal"}).to_list(100)
-        legal_mission_ids = [m["id"] for m in legal_missions]
-        completed_legal = len([m for m in legal_mission_ids if m in user.completed_missions])
-        return completed_legal == len(legal_mission_ids)
-    
-    elif condition == "complete_sales_area":
-        sales_missions = await db.missions.find({"competence_area": "ventas"}).to_list(100)
-        sales_mission_ids = [m["id"] for m in sales_missions]
-        completed_sales = len([m for m in sales_mission_ids if m in user.completed_missions])
-        return completed_sales == len(sales_mission_ids)
-    
-    # Social badges
-    elif condition == "network_builder":
-        # Check networking missions completed
-        networking_missions = await db.missions.find({"type": "networking_task"}).to_list(100)
-        networking_completed = len([m for m in networking_missions if m["id"] in user.completed_missions])
-        return networking_completed >= 2
-    
-    return False
+class BadgeSubject:
+    """The parts of a user document badge predicates look at"""
+
+    def __init__(self, points: int, current_streak: int, completed_missions: List[str], bitmap: Optional[bytes] = None):
+        self.points = points
+        self.current_streak = current_streak
+        self.missions_completed = len(completed_missions)
+        self.completed_missions = completed_missions
+        self.bitmap = bitmap
+        self._completed = None
+
+    def scoped_count(self, predicate: "BadgePredicate", catalog: MissionCatalog) -> int:
+        mask = catalog.completed_mask(self.completed_missions, self.bitmap)
+        if mask is not None:
+            scope_masks = catalog.area_masks if predicate.metric == "area_missions" else catalog.type_masks
+            return (mask & scope_masks.get(predicate.scope, 0)).bit_count()
+        if self._completed is None:
+            self._completed = set(self.completed_missions)
+        return len(predicate.scope_ids(catalog) & self._completed)
+
+    @classmethod
+    def from_user(cls, user: User) -> "BadgeSubject":
+        return cls(user.points, user.current_streak, user.completed_missions, user.completed_missions_bitmap)
+
+    @classmethod
+    def from_document(cls, user: dict) -> "BadgeSubject":
+        return cls(
+            user.get("points", 0),
+            user.get("current_streak", 0),
+            user.get("completed_missions", []),
+            user.get("completed_missions_bitmap")
+        )
+
+class BadgePredicate:
+    """Compiled badge condition"""
+
+    def __init__(self, metric: str, comparator: str, threshold: Union[int, str], scope: Optional[str] = None):
+        self.metric = metric
+        self.comparator = comparator
+        self.threshold = threshold
+        self.scope = scope
+
+    def scope_ids(self, catalog: MissionCatalog) -> frozenset:
+        if self.metric == "area_missions":
+            return catalog.area_ids(self.scope)
+        return catalog.type_ids(self.scope)
+
+    def target(self, catalog: MissionCatalog) -> int:
+        """Threshold as a number; "all" is the size of the scope"""
+        if self.threshold == "all":
+            return len(self.scope_ids(catalog))
+        return self.threshold
+
+    def current(self, subject: BadgeSubject, catalog: MissionCatalog) -> int:
+        if self.metric == "missions_completed":
+            return subject.missions_completed
+        if self.metric == "points":
+            return subject.points
+        if self.metric == "streak":
+            return subject.current_streak
+        return subject.scoped_count(self, catalog)
+
+    def is_met(self, subject: BadgeSubject, catalog: MissionCatalog) -> bool:
+        return BADGE_COMPARATORS[self.comparator](self.current(subject, catalog), self.target(catalog))
+
+def parse_badge_condition(condition: str) -> BadgePredicate:
+    """Compile a badge condition string, raising ValueError if it is not understood"""
+    condition = condition.strip()
+    if condition in LEGACY_BADGE_CONDITIONS:
+        return BadgePredicate(*LEGACY_BADGE_CONDITIONS[condition])
+    for pattern, metric in LEGACY_BADGE_PATTERNS:
+        match = pattern.match(condition)
+        if match:
+            return BadgePredicate(metric, ">=", int(match.group(1)))
+
+    match = BADGE_CONDITION_PATTERN.match(condition)
+    if not match:
+        raise ValueError(f"Unrecognized badge condition '{condition}'")
+    metric, scope, threshold = match.group("metric"), match.group("scope"), match.group("threshold")
+    if metric not in BADGE_METRICS:
+        raise ValueError(f"Unknown badge metric '{metric}'")
+    if (metric in SCOPED_BADGE_METRICS) != (scope is not None):
+        raise ValueError(f"Metric '{metric}' {'requires' if scope is None else 'does not take'} a scope")
+    if scope is not None:
+        known_scopes = (
+            {area.value for area in CompetenceArea} if metric == "area_missions"
+            else {mission_type.value for mission_type in MissionType}
+        )
+        if scope not in known_scopes:
+            raise ValueError(f"Unknown scope '{scope}' for metric '{metric}'")
+    if threshold == "all" and scope is None:
+        raise ValueError("Threshold 'all' needs a scoped metric")
+    return BadgePredicate(metric, match.group("comparator"), threshold if threshold == "all" else int(threshold), scope)
+
+def compile_badge_condition(condition: str) -> Optional[BadgePredicate]:
+    """Predicate for a stored condition, None when it cannot be compiled (never awarded)"""
+    try:
+        return parse_badge_condition(condition)
+    except ValueError as e:
+        print(f"Ignoring badge condition: {e}")
+        return None
+
+class BadgeRuleRegistry:
+    """Every badge with its compiled predicate, loaded once from the badges collection"""
+
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self.rules: List[tuple] = []
+        self.loaded_at = 0.0
+
+    async def get_rules(self) -> List[tuple]:
+        """(Badge, predicate) pairs; badges whose condition did not compile are left out"""
+        if time.monotonic() - self.loaded_at > self.refresh_seconds:
+            rules = []
+            async for badge_data in db.badges.find({}, {"_id": 0}):
+                badge = Badge(**badge_data)
+                predicate = compile_badge_condition(badge.condition)
+                if predicate is not None:
+                    rules.append((badge, predicate))
+            self.rules = rules
+            self.loaded_at = time.monotonic()
+        return self.rules
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+badge_rule_registry = BadgeRuleRegistry(BADGE_RULES_REFRESH_SECONDS)
+
+# Enhanced utility functions
+# Minimum points for each level, shared by Python code and the completion pipeline update
+USER_LEVEL_THRESHOLDS = [
+    (UserLevel.NOVATO, 0),
+    (UserLevel.PRINCIPIANTE, 100),
+    (UserLevel.INTERMEDIO, 300),
+    (UserLevel.AVANZADO, 600),
+    (UserLevel.EXPERTO, 1000),
+    (UserLevel.MAESTRO, 1500),
+    (UserLevel.LEYENDA, 2500)
+]
+
+async def calculate_user_level(points: int) -> tuple[UserLevel, int]:
+    """Calculate user level based on points and return (level, points_in_level)"""
+    current_level = UserLevel.NOVATO
+    level_points = points
+    
+    for level, threshold in reversed(USER_LEVEL_THRESHOLDS):
+        if points >= threshold:
+            current_level = level
+            level_points = points - threshold
+            break
+    
+    return current_level, level_points
+
+def badge_notification(user_id: str, badge: Badge) -> Notification:
+    return Notification(
+        # One notification per award, however many times delivery is retried
+        id=f"badge:{user_id}:{badge.id}",
+        user_id=user_id,
+        type=NotificationType.NEW_BADGE,
+        title=f"¡Nueva insignia desbloqueada!",
+        message=f"Has obtenido la insignia '{badge.title}' y ganado {badge.coins_reward} monedas!",
+        data={"badge_id": badge.id, "badge_title": badge.title, "coins_awarded": badge.coins_reward}
+    )
+
+async def insert_user_badges(user_badges: List[UserBadge]) -> List[UserBadge]:
+    """Insert awards, returning only the ones that were new.
+
+    The unique (user_id, badge_id) index makes this idempotent: an award that
+    already exists (e.g. from a concurrent request) is reported as a
+    duplicate and skipped instead of being granted twice.
+    """
+    if not user_badges:
+        return []
+    try:
+        await db.user_badges.insert_many([user_badge.dict() for user_badge in user_badges], ordered=False)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in write_errors):
+            raise
+        duplicates = {error["index"] for error in write_errors}
+        return [user_badge for i, user_badge in enumerate(user_badges) if i not in duplicates]
+    return user_badges
 
 async def award_badges_to_user(user: User):
-    """Check and award new badges to user"""
-    badges_awarded = []
+    """Check and award new badges to user.
+
+    Safe to re-run after a partial failure: an award row the user's badge
+    list does not show yet is notified and paid again, and both writes are
+    guarded so nothing is granted twice.
+    """
+    badge_rules = await badge_rule_registry.get_rules()
+    if not badge_rules:
+        return []
+    badges_by_id = {badge.id: badge for badge, _ in badge_rules}
     
-    # Get all badges
-    all_badges = await db.badges.find().to_list(100)
+    # Badges the user already has, read once
+    earned = set()
+    async for user_badge in db.user_badges.find({"user_id": user.id}, {"_id": 0, "badge_id": 1}):
+        earned.add(user_badge["badge_id"])
     
-    for badge_data in all_badges:
-        badge = Badge(**badge_data)
-        
-        # Check if user already has this badge
-        user_badge = await db.user_badges.find_one({"user_id": user.id, "badge_id": badge.id})
-        if user_badge:
-            continue
-        
-        # Check if user is eligible
-        if await check_badge_eligibility(user, badge):
-            # Award badge
-            new_user_badge = UserBadge(
-                user_id=user.id,
-                badge_id=badge.id
-            )
-            await db.user_badges.insert_one(new_user_badge.dict())
+    # Awards recorded by an earlier attempt that failed before paying them
+    badges_awarded = [
+        badges_by_id[badge_id] for badge_id in earned - set(user.badges) if badge_id in badges_by_id
+    ]
+    
+    catalog = await get_mission_catalog()
+    subject = BadgeSubject.from_user(user)
+    candidates = {
+        badge.id: badge for badge, predicate in badge_rules
+        if badge.id not in earned and predicate.is_met(subject, catalog)
+    }
+    inserted = await insert_user_badges([UserBadge(user_id=user.id, badge_id=badge_id) for badge_id in candidates])
+    badges_awarded.extend(candidates[user_badge.badge_id] for user_badge in inserted)
+    if not badges_awarded:
+        return []
+    
+    # Notify before paying: the badge list is what marks an award as done,
+    # so a retry after either write fails redoes both
+    await insert_notifications([badge_notification(user.id, badge).dict() for badge in badges_awarded])
+    
+    # Guarded per badge, so a backfill paying the same award concurrently
+    # leaves exactly one coin grant and one badge list entry
+    await db.users.bulk_write([
+        UpdateOne(
+            {"id": user.id, "badges": {"$ne": badge.id}},
+            {"$push": {"badges": badge.id}, "$inc": {"coins": badge.coins_reward}}
+        )
+        for badge in badges_awarded
+    ], ordered=False)
+    invalidate_cached_user(user.id)
+    
+    return badges_awarded
+
+# Badge backfill
+# A badge created after users already qualify is granted by a resumable sweep
+# over the users collection in id order. Progress is checkpointed on the job
+# document after every batch, and a lease keeps two workers from running the
+# same job; an expired lease lets another worker (or a restart) resume it.
+BADGE_BACKFILL_BATCH_SIZE = int(os.environ.get("BADGE_BACKFILL_BATCH_SIZE", 1000))
+BADGE_BACKFILL_LEASE_SECONDS = 120
+# Identifies this API process as a lease owner
+BACKFILL_WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+async def claim_badge_backfill_job(job_id: str) -> Optional[dict]:
+    """Take the lease on an unfinished job, None if any sweep (this process's included) holds it"""
+    now = datetime.utcnow()
+    return await db.badge_backfill_jobs.find_one_and_update(
+        {
+            "id": job_id,
+            "status": {"$in": [BackfillStatus.PENDING, BackfillStatus.RUNNING]},
+            # A sweep renews its lease at every checkpoint, so a live lease
+            # always means a running loop; never claim it a second time
+            "$or": [
+                {"lease_owner": None},
+                {"lease_expires_at": {"$lt": now}}
+            ]
+        },
+        {"$set": {
+            "status": BackfillStatus.RUNNING,
+            "lease_owner": BACKFILL_WORKER_ID,
+            "lease_expires_at": now + timedelta(seconds=BADGE_BACKFILL_LEASE_SECONDS),
+            "updated_at": now
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def finish_badge_backfill_job(job_id: str, status: BackfillStatus, error: Optional[str] = None):
+    now = datetime.utcnow()
+    await db.badge_backfill_jobs.update_one(
+        {"id": job_id, "lease_owner": BACKFILL_WORKER_ID},
+        {"$set": {
+            "status": status,
+            "error": error,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": now,
+            "completed_at": now
+        }}
+    )
+
+async def award_badge_to_batch(badge: Badge, user_ids: List[str], job_id: str) -> int:
+    """Grant one badge to a batch of qualifying users, returning how many were new"""
+    inserted = await insert_user_badges([
+        UserBadge(user_id=user_id, badge_id=badge.id, awarded_by=job_id) for user_id in user_ids
+    ])
+    payable = {user_badge.user_id for user_badge in inserted}
+    # A duplicate row tagged with this job means the batch is being replayed
+    # after a crash: the award landed but its coins may not have. Rows from
+    # any other source are paid by whoever inserted them.
+    duplicates = [user_id for user_id in user_ids if user_id not in payable]
+    if duplicates:
+        async for row in db.user_badges.find(
+            {"user_id": {"$in": duplicates}, "badge_id": badge.id, "awarded_by": job_id},
+            {"_id": 0, "user_id": 1}
+        ):
+            payable.add(row["user_id"])
+    if not payable:
+        return 0
+    
+    await insert_notifications([badge_notification(user_id, badge).dict() for user_id in payable])
+    # Guarded on the badge list so a replayed payment never lands twice
+    await db.users.bulk_write([
+        UpdateOne(
+            {"id": user_id, "badges": {"$ne": badge.id}},
+            {"$push": {"badges": badge.id}, "$inc": {"coins": badge.coins_reward}}
+        )
+        for user_id in payable
+    ], ordered=False)
+    for user_id in payable:
+        invalidate_cached_user(user_id)
+    return len(inserted)
+
+async def run_badge_backfill(job_id: str):
+    """Sweep users from the job's checkpoint, granting its badge to everyone who qualifies"""
+    job = await claim_badge_backfill_job(job_id)
+    if not job:
+        return
+    
+    badge_data = await db.badges.find_one({"id": job["badge_id"]}, {"_id": 0})
+    predicate = compile_badge_condition(badge_data["condition"]) if badge_data else None
+    if predicate is None:
+        await finish_badge_backfill_job(job_id, BackfillStatus.FAILED, "Badge not found or condition not understood")
+        return
+    badge = Badge(**badge_data)
+    catalog = await get_mission_catalog()
+    last_user_id = job.get("last_user_id")
+    
+    try:
+        while True:
+            started = time.monotonic()
+            query = {"id": {"$gt": last_user_id}} if last_user_id else {}
+            users = await db.users.find(query, BADGE_SUBJECT_PROJECTION).sort("id", 1).limit(
+                BADGE_BACKFILL_BATCH_SIZE
+            ).to_list(BADGE_BACKFILL_BATCH_SIZE)
+            if not users:
+                break
             
-            # Update user's badge list and award coins
-            await db.users.update_one(
-                {"id": user.id},
+            qualifying = [
+                user["id"] for user in users
+                if predicate.is_met(BadgeSubject.from_document(user), catalog)
+            ]
+            awarded = await award_badge_to_batch(badge, qualifying, job_id) if qualifying else 0
+            last_user_id = users[-1]["id"]
+            
+            now = datetime.utcnow()
+            checkpoint = await db.badge_backfill_jobs.update_one(
+                {"id": job_id, "lease_owner": BACKFILL_WORKER_ID},
                 {
-                    "$push": {"badges": badge.id},
-                    "$inc": {"coins": badge.coins_reward}
+                    "$set": {
+                        "last_user_id": last_user_id,
+                        "lease_expires_at": now + timedelta(seconds=BADGE_BACKFILL_LEASE_SECONDS),
+                        "updated_at": now
+                    },
+                    "$inc": {
+                        "users_processed": len(users),
+                        "badges_awarded": awarded,
+                        "elapsed_seconds": time.monotonic() - started
+                    }
                 }
             )
-            
-            badges_awarded.append(badge)
-            
-            # Create notification
-            notification = Notification(
-                user_id=user.id,
-                type=NotificationType.NEW_BADGE,
-                title=f"¡Nueva insignia desbloqueada!",
-                message=f"Has obtenido la insignia '{badge.title}' y ganado {badge.coins_reward} monedas!",
-                data={"badge_id": badge.id, "badge_title": badge.title, "coins_awarded": badge.coins_reward}
-            )
-            await db.notifications.insert_one(notification.dict())
+            if checkpoint.matched_count == 0:
+                # Lease lost to another worker, which resumes from the last checkpoint
+                return
+    except Exception as e:
+        print(f"Badge backfill {job_id} stopped at user {last_user_id}: {e}")
+        await finish_badge_backfill_job(job_id, BackfillStatus.FAILED, str(e))
+        return
     
-    return badges_awarded
+    await finish_badge_backfill_job(job_id, BackfillStatus.COMPLETED)
+
+async def start_badge_backfill(badge_id: str) -> BadgeBackfillJob:
+    """Resume the badge's unfinished backfill, or start a new sweep"""
+    existing = await db.badge_backfill_jobs.find_one(
+        {"badge_id": badge_id, "status": {"$in": [BackfillStatus.PENDING, BackfillStatus.RUNNING]}},
+        {"_id": 0}
+    )
+    job = BadgeBackfillJob(**existing) if existing else BadgeBackfillJob(badge_id=badge_id)
+    if not existing:
+        await db.badge_backfill_jobs.insert_one(job.dict())
+    spawn_background(run_badge_backfill(job.id))
+    return job
+
+async def resume_badge_backfills():
+    """Pick up jobs left unfinished by a previous process"""
+    async for job in db.badge_backfill_jobs.find(
+        {"status": {"$in": [BackfillStatus.PENDING, BackfillStatus.RUNNING]}}, {"_id": 0, "id": 1}
+    ):
+        spawn_background(run_badge_backfill(job["id"]))
+
+def badge_backfill_report(job: BadgeBackfillJob) -> dict:
+    report = job.dict()
+    report["users_per_second"] = (
+        round(job.users_processed / job.elapsed_seconds, 1) if job.elapsed_seconds else None
+    )
+    return report
+
+# Badge progress
+# badge_progress holds the counters every badge metric is computed from, so a
+# progress view is one indexed read plus in-memory predicate evaluation.
+# Completions apply their deltas; a missing document is rebuilt from the user
+# on first read, which is also how admin edits and mission edits invalidate it.
+async def record_badge_progress(user_id: str, mission: Mission, points_awarded: int, current_streak: int):
+    """Apply a mission completion to the user's badge counters, once per mission"""
+    await db.badge_progress.update_one(
+        {"user_id": user_id, "counted_missions": {"$ne": mission.id}},
+        {
+            "$push": {"counted_missions": mission.id},
+            "$inc": {
+                "missions_completed": 1,
+                "points": points_awarded,
+                f"area_missions.{mission.competence_area.value}": 1,
+                f"type_missions.{mission.type.value}": 1
+            },
+            "$set": {"current_streak": current_streak, "updated_at": datetime.utcnow()}
+        }
+    )
+
+async def invalidate_badge_progress(user_id: str):
+    await db.badge_progress.delete_one({"user_id": user_id})
 
-async def check_and_update_user_level(user: User):
-    """Check and update user level, return True if level changed"""
-    new_level, level_points = await calculate_user_level(user.points)
+async def invalidate_mission_badge_progress(mission_id: str):
+    """Drop counters that filed a mission under an area or type it no longer has"""
+    await db.badge_progress.delete_many({"counted_missions": mission_id})
+
+async def get_badge_progress(user_id: str) -> Optional[BadgeProgress]:
+    """Stored counters, built from the user document when missing"""
+    progress = await db.badge_progress.find_one({"user_id": user_id}, {"_id": 0})
+    if progress:
+        return BadgeProgress(**progress)
     
-    if new_level != user.level:
-        old_level = user.level
-        
-        # Update user level
-        await db.users.update_one(
-            {"id": user.id},
-            {
-                "$set": {
-                    "level": new_level,
-                    "level_points": level_points,
-                    "updated_at": datetime.utcnow()
+    user = await db.users.find_one({"id": user_id}, BADGE_SUBJECT_PROJECTION)
+    if not user:
+        return None
+    catalog = await get_mission_catalog()
+    completed_missions = user.get("completed_missions", [])
+    area_missions: Dict[str, int] = {}
+    type_missions: Dict[str, int] = {}
+    for mission_id in completed_missions:
+        mission = catalog.by_id.get(mission_id)
+        if mission:
+            area_missions[mission.competence_area.value] = area_missions.get(mission.competence_area.value, 0) + 1
+            type_missions[mission.type.value] = type_missions.get(mission.type.value, 0) + 1
+    progress = BadgeProgress(
+        user_id=user_id,
+        missions_completed=len(completed_missions),
+        points=user.get("points", 0),
+        current_streak=user.get("current_streak", 0),
+        area_missions=area_missions,
+        type_missions=type_missions,
+        counted_missions=completed_missions
+    )
+    counted = len(completed_missions)
+    # Never overwrite a copy that has already counted more completions
+    try:
+        await db.badge_progress.update_one(
+            {"user_id": user_id, "$expr": {"$lte": [{"$size": {"$ifNull": ["$counted_missions", []]}}, counted]}},
+            {"$set": progress.dict()},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return progress
+    # A completion that landed while this was built found no document to
+    # update; drop the stale copy so the next read rebuilds it
+    unchanged = await db.users.count_documents({
+        "id": user_id,
+        "$expr": {"$eq": [{"$size": {"$ifNull": ["$completed_missions", []]}}, counted]}
+    })
+    if not unchanged:
+        await db.badge_progress.delete_one({"user_id": user_id, "counted_missions": {"$size": counted}})
+    return progress
+
+def mission_completed_notification(payload: Dict[str, Any], level_changed: bool, badges_awarded: int) -> Notification:
+    return Notification(
+        user_id=payload["user_id"],
+        type=NotificationType.MISSION_AVAILABLE,
+        title="¡Misión Completada!",
+        message=f"Has completado '{payload['mission_title']}' y ganado {payload['points_awarded']} puntos y {payload['coins_awarded']} monedas.",
+        data={
+            "mission_id": payload["mission_id"],
+            "points_awarded": payload["points_awarded"],
+            "coins_awarded": payload["coins_awarded"],
+            "level_changed": level_changed,
+            "badges_awarded": badges_awarded
+        }
+    )
+
+def level_up_notification(user_id: str, old_level: UserLevel, new_level: UserLevel) -> Notification:
+    return Notification(
+        user_id=user_id,
+        type=NotificationType.LEVEL_UP,
+        title=f"¡Subiste de nivel!",
+        message=f"Has alcanzado el nivel {new_level.value.title()}",
+        data={"old_level": old_level, "new_level": new_level}
+    )
+
+def level_expression(points: Any) -> dict:
+    """The level a points expression falls into, as an aggregation expression"""
+    return {"$switch": {
+        "branches": [
+            {"case": {"$gte": [points, threshold]}, "then": level.value}
+            for level, threshold in reversed(USER_LEVEL_THRESHOLDS)
+        ],
+        "default": UserLevel.NOVATO.value
+    }}
+
+def mission_completion_pipeline(mission: Mission, event_id: str, notify: bool) -> List[dict]:
+    """Aggregation-pipeline update applying a completion's rewards, streak and level.
+
+    The same update appends the completion's outbox event to the user's
+    pending_events, so the event commits with the completion or not at all.
+    """
+    now = datetime.utcnow()
+    today = datetime(now.year, now.month, now.day)
+    yesterday = today - timedelta(days=1)
+    streak = {"$ifNull": ["$current_streak", 0]}
+    mission_id = {"$literal": mission.id}
+    points_awarded = mission.points_reward
+    coins_awarded = mission.coins_reward
+    return [
+        {"$set": {
+            # Read before this stage replaces points
+            "_previous_level": level_expression({"$ifNull": ["$points", 0]}),
+            "completed_missions": {"$concatArrays": [{"$ifNull": ["$completed_missions", []]}, [mission_id]]},
+            "points": {"$add": [{"$ifNull": ["$points", 0]}, points_awarded]},
+            "coins": {"$add": [{"$ifNull": ["$coins", 0]}, coins_awarded]},
+            "weekly_xp": {"$add": [{"$ifNull": ["$weekly_xp", 0]}, points_awarded]},
+            # Same day keeps the streak, the day after extends it, anything else restarts it
+            "current_streak": {"$switch": {
+                "branches": [
+                    {"case": {"$gte": ["$last_mission_date", today]}, "then": streak},
+                    {"case": {"$gte": ["$last_mission_date", yesterday]}, "then": {"$add": [streak, 1]}}
+                ],
+                "default": 1
+            }},
+            "last_mission_date": now,
+            "updated_at": now
+        }},
+        {"$set": {
+            "best_streak": {"$max": [{"$ifNull": ["$best_streak", 0]}, "$current_streak"]},
+            "level": level_expression("$points"),
+            "level_points": {"$switch": {
+                "branches": [
+                    {"case": {"$gte": ["$points", threshold]}, "then": {"$subtract": ["$points", threshold]}}
+                    for level, threshold in reversed(USER_LEVEL_THRESHOLDS)
+                ],
+                "default": "$points"
+            }}
+        }},
+        {"$set": {
+            "pending_events": {"$concatArrays": [{"$ifNull": ["$pending_events", []]}, [{
+                "id": {"$literal": event_id},
+                "type": "mission_completed",
+                "created_at": now,
+                "payload": {
+                    "user_id": "$id",
+                    "mission_id": mission_id,
+                    "mission_title": {"$literal": mission.title},
+                    "points_awarded": points_awarded,
+                    "coins_awarded": coins_awarded,
+                    "current_streak": "$current_streak",
+                    "old_level": "$_previous_level",
+                    "new_level": "$level",
+                    "notify": notify
                 }
-            }
+            }]]}
+        }},
+        {"$unset": "_previous_level"}
+    ]
+
+async def apply_mission_completion(user_id: str, mission: Mission, notify: bool = False) -> Optional[dict]:
+    """Record a completed mission for a user and queue its side effects.
+
+    Rewards, streak, level and the completion's outbox event are applied by
+    one conditional update, so two concurrent completions of the same
+    mission cannot both be paid and a crash cannot lose the event. Returns
+    None if the mission was already completed, otherwise the updated user,
+    whether the level changed, the badges the outbox worker will award and
+    the missions the completion unlocked. With notify, the outbox worker
+    also sends the "mission completed" notification.
+    """
+    updated_user = await db.users.find_one_and_update(
+        {"id": user_id, "completed_missions": {"$ne": mission.id}},
+        mission_completion_pipeline(mission, str(uuid.uuid4()), notify),
+        projection={"_id": 0, "pending_events": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated_user:
+        return None
+    invalidate_cached_user(user_id)
+    outbox.relay_wakeup.set()
+    user = User(**updated_user)
+    
+    # Everything below is derived from the post-image
+    old_level, _ = await calculate_user_level(user.points - mission.points_reward)
+    
+    catalog = await get_mission_catalog()
+    return {
+        "user": user,
+        "level_changed": user.level != old_level,
+        "badges_awarded": await predict_badge_awards(user),
+        "unlocked_missions": catalog.newly_unlocked(mission.id, set(user.completed_missions))
+    }
+
+async def predict_badge_awards(user: User) -> List[Badge]:
+    """Badges award_badges_to_user will grant, judged from the user document alone"""
+    catalog = await get_mission_catalog()
+    subject = BadgeSubject.from_user(user)
+    earned = set(user.badges)
+    return [
+        badge for badge, predicate in await badge_rule_registry.get_rules()
+        if badge.id not in earned and predicate.is_met(subject, catalog)
+    ]
+
+# Outbox
+# Request handlers commit their core state change and append an outbox event;
+# side effects (notifications, badge awards, badge progress, eligibility
+# refresh) are delivered by a pool of in-process workers. Mission completions
+# write their event into the user's pending_events in the same update as the
+# completion, and a relay worker moves those into the outbox, so the event
+# can't be lost between two writes. Events are claimed in batches under a
+# lease, so a crashed worker's batch is picked up again, and failed batches
+# are retried with exponential backoff. Every handler is idempotent:
+# notifications carry deterministic ids behind a unique index, badge awards
+# hit the unique (user_id, badge_id) index and badge progress remembers which
+# missions it has counted.
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", 2))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_POLL_SECONDS = 1.0
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF_SECONDS = 300
+
+class Outbox:
+    """Durable queue of side effects, drained by background workers"""
+
+    def __init__(self, workers: int, batch_size: int):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.handlers: Dict[str, Any] = {}
+        self.wakeup = asyncio.Event()
+        self.relay_wakeup = asyncio.Event()
+        self.started = False
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+
+    def handler(self, event_type: str):
+        """Register the coroutine that delivers a batch of events of one type"""
+        def register(func):
+            self.handlers[event_type] = func
+            return func
+        return register
+
+    async def publish(self, event_type: str, payload: Dict[str, Any], event_id: Optional[str] = None):
+        """Append an event; publishing the same event_id twice is a no-op"""
+        event = OutboxEvent(type=event_type, payload=payload)
+        if event_id:
+            event.id = event_id
+        try:
+            await db.outbox.insert_one(event.dict())
+        except DuplicateKeyError:
+            return
+        self.wakeup.set()
+
+    async def claim_batch(self) -> List[dict]:
+        now = datetime.utcnow()
+        claimable = {"$or": [
+            {"status": OutboxStatus.PENDING, "available_at": {"$lte": now}},
+            {"status": OutboxStatus.PROCESSING, "lease_expires_at": {"$lt": now}}
+        ]}
+        candidates = await db.outbox.find(claimable, {"_id": 0, "id": 1}).sort("available_at", 1).limit(
+            self.batch_size
+        ).to_list(self.batch_size)
+        if not candidates:
+            return []
+        # The claim re-checks the filter, so candidates taken by another worker are skipped
+        claim_token = uuid.uuid4().hex
+        await db.outbox.update_many(
+            {"id": {"$in": [c["id"] for c in candidates]}, **claimable},
+            {"$set": {
+                "status": OutboxStatus.PROCESSING,
+                "claim_token": claim_token,
+                "lease_expires_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+            }}
         )
+        return await db.outbox.find({"claim_token": claim_token}, {"_id": 0}).to_list(self.batch_size)
+
+    async def deliver(self, events: List[dict]):
+        now = datetime.utcnow()
+        lag = max((now - event["created_at"]).total_seconds() for event in events)
+        self.last_lag_seconds = lag
+        self.max_lag_seconds = max(self.max_lag_seconds, lag)
         
-        # Create notification
-        notification = Notification(
-            user_id=user.id,
-            type=NotificationType.LEVEL_UP,
-            title=f"¡Subiste de nivel!",
-            message=f"Has alcanzado el nivel {new_level.value.title()}",
-            data={"old_level": old_level, "new_level": new_level}
-        )
-        await db.notifications.insert_one(notification.dict())
+        by_type: Dict[str, List[dict]] = {}
+        for event in events:
+            by_type.setdefault(event["type"], []).append(event)
         
-        return True
-    
-    return False
+        for event_type, typed_events in by_type.items():
+            ids = [event["id"] for event in typed_events]
+            try:
+                await self.handlers[event_type](typed_events)
+            except Exception as e:
+                print(f"Outbox delivery of {len(ids)} {event_type} events failed: {e}")
+                await self.retry(typed_events, str(e))
+                continue
+            await db.outbox.update_many(
+                {"id": {"$in": ids}},
+                {"$set": {"status": OutboxStatus.DONE, "processed_at": datetime.utcnow(), "claim_token": None}}
+            )
+            self.delivered += len(ids)
+
+    async def retry(self, events: List[dict], error: str):
+        now = datetime.utcnow()
+        for event in events:
+            attempts = event.get("attempts", 0) + 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                # Failed events have no processed_at, so the TTL index keeps them for inspection
+                update = {"status": OutboxStatus.FAILED}
+                self.failed += 1
+            else:
+                backoff = min(2 ** attempts, OUTBOX_MAX_BACKOFF_SECONDS)
+                update = {"status": OutboxStatus.PENDING, "available_at": now + timedelta(seconds=backoff)}
+                self.retried += 1
+            await db.outbox.update_one(
+                {"id": event["id"]},
+                {"$set": {**update, "attempts": attempts, "last_error": error, "claim_token": None}}
+            )
 
-async def update_user_streak(user_id: str):
-    """Update user's mission streak"""
-    user = await db.users.find_one({"id": user_id})
-    if not user:
-        return
-    
-    today = datetime.utcnow().date()
-    last_mission_date = user.get("last_mission_date")
-    
-    if last_mission_date:
-        last_date = last_mission_date.date() if isinstance(last_mission_date, datetime) else last_mission_date
-        if last_date == today:
-            # Same day, don't update streak
+    async def run_worker(self):
+        while True:
+            try:
+                events = await self.claim_batch()
+                if events:
+                    await self.deliver(events)
+                    continue
+            except Exception as e:
+                print(f"Outbox worker error: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def relay_batch(self) -> int:
+        """Move events committed inside user documents into the outbox"""
+        users = await db.users.find(
+            {"pending_events.id": {"$exists": True}}, {"_id": 0, "id": 1, "pending_events": 1}
+        ).limit(self.batch_size).to_list(self.batch_size)
+        for user in users:
+            events = [OutboxEvent(**event).dict() for event in user["pending_events"]]
+            try:
+                await db.outbox.insert_many(events, ordered=False)
+            except BulkWriteError as e:
+                # Already relayed by another worker
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            await db.users.update_one(
+                {"id": user["id"]},
+                {"$pull": {"pending_events": {"id": {"$in": [event["id"] for event in events]}}}}
+            )
+        if users:
+            self.wakeup.set()
+        return len(users)
+
+    async def run_relay(self):
+        while True:
+            try:
+                if await self.relay_batch():
+                    continue
+            except Exception as e:
+                print(f"Outbox relay error: {e}")
+            self.relay_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.relay_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.started:
             return
-        elif last_date == today - timedelta(days=1):
-            # Consecutive day, increase streak
-            new_streak = user.get("current_streak", 0) + 1
-        else:
-            # Streak broken, reset to 1
-            new_streak = 1
-    else:
-        # First mission
-        new_streak = 1
-    
-    # Update best streak if needed
-    best_streak = max(user.get("best_streak", 0), new_streak)
-    
-    await db.users.update_one(
-        {"id": user_id},
-        {
-            "$set": {
-                "current_streak": new_streak,
-                "best_streak": best_streak,
-                "last_mission_date": datetime.utcnow()
-            }
+        self.started = True
+        spawn_background(self.run_relay())
+        for _ in range(self.workers):
+            spawn_background(self.run_worker())
+
+    async def stats(self) -> dict:
+        oldest = await db.outbox.find_one(
+            {"status": {"$in": [OutboxStatus.PENDING, OutboxStatus.PROCESSING]}},
+            {"_id": 0, "created_at": 1},
+            sort=[("created_at", 1)]
+        )
+        return {
+            "workers": self.workers,
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "failed": self.failed,
+            "last_lag_seconds": round(self.last_lag_seconds, 3),
+            "max_lag_seconds": round(self.max_lag_seconds, 3),
+            "oldest_pending_seconds": (
+                round((datetime.utcnow() - oldest["created_at"]).total_seconds(), 3) if oldest else 0.0
+            )
         }
-    )
+
+outbox = Outbox(OUTBOX_WORKERS, OUTBOX_BATCH_SIZE)
+
+async def publish_notification(notification: Notification):
+    """Queue a notification; its id doubles as the outbox event id"""
+    await outbox.publish("notification", {"notification": notification.dict()}, event_id=f"notification:{notification.id}")
+
+@outbox.handler("notification")
+async def deliver_notifications(events: List[dict]):
+    await insert_notifications([event["payload"]["notification"] for event in events])
+
+async def insert_notifications(notifications: List[dict]):
+    """Insert notifications, skipping ones already delivered by an earlier attempt"""
+    if not notifications:
+        return
+    try:
+        await db.notifications.insert_many(notifications, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+@outbox.handler("mission_completed")
+async def deliver_mission_completions(events: List[dict]):
+    catalog = await get_mission_catalog()
+    notifications = []
+    for event in events:
+        payload = event["payload"]
+        user_id = payload["user_id"]
+        level_changed = payload["new_level"] != payload["old_level"]
+        if level_changed:
+            notification = level_up_notification(
+                user_id, UserLevel(payload["old_level"]), UserLevel(payload["new_level"])
+            )
+            notification.id = f"{event['id']}:level_up"
+            notifications.append(notification.dict())
+        
+        badges_awarded = []
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if user:
+            await store_completed_bitmap(user, catalog)
+            badges_awarded = await award_badges_to_user(User(**user))
+        
+        if payload.get("notify"):
+            notification = mission_completed_notification(payload, level_changed, len(badges_awarded))
+            notification.id = f"{event['id']}:completed"
+            notifications.append(notification.dict())
+        
+        mission = catalog.by_id.get(payload["mission_id"])
+        if mission:
+            await record_badge_progress(user_id, mission, payload["points_awarded"], payload["current_streak"])
+            # Refresh stored eligibility rows that depend on this mission, points or streak
+            await invalidate_user_eligibility(user_id, mission_completion_change(mission))
+    await insert_notifications(notifications)
+
+def is_mission_in_cooldown(failed_missions: Dict[str, Any], mission_id: str) -> bool:
+    """Whether a failed mission's 7-day cooldown is still running"""
+    failed_date = failed_missions.get(mission_id)
+    if not failed_date:
+        return False
+    if isinstance(failed_date, str):
+        failed_date = datetime.fromisoformat(failed_date)
+    return datetime.utcnow() < failed_date + timedelta(days=7)
 
 async def check_mission_cooldown(user_id: str, mission_id: str) -> bool:
     """Check if user can attempt a mission or is in cooldown"""
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "failed_missions": 1})
     if not user:
         return True
     
-    failed_missions = user.get("failed_missions", {})
-    if mission_id in failed_missions:
-        failed_date = failed_missions[mission_id]
-        if isinstance(failed_date, str):
-            failed_date = datetime.fromisoformat(failed_date)
+    return not is_mission_in_cooldown(user.get("failed_missions", {}), mission_id)
+
+# Idempotency keys
+# Clients retry POSTs over flaky connections with an Idempotency-Key header.
+# The first request with a key reserves it and stores its response; a replay
+# gets the stored response without running the handler again. Completed
+# responses are also kept in a process-local LRU so hot replays skip MongoDB.
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", 24))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+# A reservation older than this is assumed to belong to a crashed request
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Errors that retrying cannot change (unlike e.g. out of stock or not enough coins)
+IDEMPOTENCY_FINAL_ERROR_CODES = {403, 404, 410, 422}
+
+class IdempotencyStore:
+    """Reservations and stored responses per (user, key)"""
+
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self._responses: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.replays = 0
+        self.conflicts = 0
+
+    def _remember(self, cache_key: tuple, record: dict):
+        self._responses[cache_key] = record
+        self._responses.move_to_end(cache_key)
+        while len(self._responses) > self.cache_size:
+            self._responses.popitem(last=False)
+
+    def _replay(self, record: dict, fingerprint: str) -> dict:
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        self.replays += 1
+        return record
+
+    async def reserve(self, user_id: str, key: str, fingerprint: str) -> Optional[dict]:
+        """Reserve the key, or return the stored response of the request that used it"""
+        cached = self._responses.get((user_id, key))
+        if cached:
+            self._responses.move_to_end((user_id, key))
+            return self._replay(cached, fingerprint)
+        
+        now = datetime.utcnow()
+        try:
+            await db.idempotency_keys.insert_one({
+                "user_id": user_id,
+                "key": key,
+                "fingerprint": fingerprint,
+                "state": "in_progress",
+                "locked_at": now,
+                "expires_at": now + timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+        
+        # Take over a reservation abandoned by a crashed request
+        taken_over = await db.idempotency_keys.find_one_and_update(
+            {
+                "user_id": user_id,
+                "key": key,
+                "fingerprint": fingerprint,
+                "state": "in_progress",
+                "locked_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}
+            },
+            {"$set": {"locked_at": now}}
+        )
+        if taken_over:
+            return None
         
-        # Check if 7 days have passed
-        if datetime.utcnow() < failed_date + timedelta(days=7):
-            return False
+        existing = await db.idempotency_keys.find_one({"user_id": user_id, "key": key}, {"_id": 0})
+        if existing is None:
+            # Expired or abandoned between our insert and read; let the client retry
+            raise HTTPException(status_code=409, detail="Request with this Idempotency-Key is being retried, try again")
+        if existing["state"] == "completed":
+            self._remember((user_id, key), existing)
+            return self._replay(existing, fingerprint)
+        if existing["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        self.conflicts += 1
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+    async def complete(self, user_id: str, key: str, fingerprint: str, status_code: int, body: Any):
+        record = {"fingerprint": fingerprint, "state": "completed", "status_code": status_code, "body": body}
+        await db.idempotency_keys.update_one(
+            {"user_id": user_id, "key": key},
+            {"$set": {"state": "completed", "status_code": status_code, "body": body}}
+        )
+        self._remember((user_id, key), record)
+
+    async def release(self, user_id: str, key: str):
+        """Forget a reservation whose request failed unexpectedly, so a retry runs again"""
+        await db.idempotency_keys.delete_one({"user_id": user_id, "key": key, "state": "in_progress"})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cached_responses": len(self._responses),
+            "max_size": self.cache_size,
+            "replays": self.replays,
+            "conflicts": self.conflicts
+        }
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE)
+
+def request_fingerprint(action: str, body: Any = None) -> str:
+    """Identify a request by its action and a hash of its body, so a reused key with another body is caught"""
+    if body is None:
+        return action
+    digest = hashlib.sha256(json.dumps(jsonable_encoder(body), sort_keys=True).encode()).hexdigest()
+    return f"{action}:{digest}"
+
+async def run_idempotent(idempotency_key: Optional[str], user_id: str, fingerprint: str, handler):
+    """Run handler() once per Idempotency-Key, replaying its stored outcome on retries.
+
+    Successful responses and final HTTP errors are stored; any other
+    failure releases the key so the retry executes the handler again.
+    """
+    if not idempotency_key:
+        return await handler()
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+    
+    stored = await idempotency_store.reserve(user_id, idempotency_key, fingerprint)
+    if stored is not None:
+        if stored["status_code"] >= 400:
+            raise HTTPException(status_code=stored["status_code"], detail=stored["body"]["detail"])
+        return JSONResponse(
+            status_code=stored["status_code"],
+            content=stored["body"],
+            headers={"Idempotent-Replayed": "true"}
+        )
     
-    return True
+    try:
+        result = await handler()
+    except HTTPException as e:
+        if e.status_code in IDEMPOTENCY_FINAL_ERROR_CODES:
+            await idempotency_store.complete(user_id, idempotency_key, fingerprint, e.status_code, {"detail": e.detail})
+        else:
+            await idempotency_store.release(user_id, idempotency_key)
+        raise
+    except BaseException:
+        await idempotency_store.release(user_id, idempotency_key)
+        raise
+    await idempotency_store.complete(user_id, idempotency_key, fingerprint, 200, jsonable_encoder(result))
+    return result
 
 # CORS middleware - ACTUALIZAR ESTA PARTE
 app.add_middleware(
@@ -1900,7 +4309,7 @@ async def init_admin():
         cedula="0000000000",
         email="admin@impulsaguayaquil.com",
         nombre_emprendimiento="Sistema Administrativo",
-        hashed_password=get_password_hash("admin"),
+        hashed_password=await get_password_hash_async("admin"),
         role=UserRole.ADMIN,
         rank=UserRank.EMPRENDEDOR_MASTER,
         points=10000,
@@ -1922,7 +4331,7 @@ async def register(user_data: UserCreate):
         )
     
     # Create user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
     user = User(
         nombre=user_data.nombre,
         apellido=user_data.apellido,
@@ -1941,7 +4350,7 @@ async def register(user_data: UserCreate):
 @api_router.post("/login", response_model=Token)
 async def login(user_credentials: UserLogin):
     user = await db.users.find_one({"cedula": user_credentials.cedula})
-    if not user or not verify_password(user_credentials.password, user["hashed_password"]):
+    if not user or not await verify_password_async(user_credentials.password, user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect cedula or password",
@@ -1969,7 +4378,11 @@ async def login(user_credentials: UserLogin):
 
 @api_router.get("/me", response_model=UserResponse)
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
-    return UserResponse(**current_user.dict())
+    # The auth principal omits profile_picture/favorite_rewards, so load the full profile here
+    user = await db.users.find_one({"id": current_user.id})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return UserResponse(**user)
 
 # Enhanced User routes
 @api_router.get("/users", response_model=List[UserResponse])
@@ -2021,6 +4434,10 @@ async def update_user(user_id: str, user_data: UserUpdate, current_user: User =
     if update_data:
         update_data["updated_at"] = datetime.utcnow()
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        invalidate_cached_user(user_id)
+        if "points" in update_data:
+            await invalidate_user_eligibility(user_id, EligibilityChange(points=True))
+            await invalidate_badge_progress(user_id)
     
     updated_user = await db.users.find_one({"id": user_id})
     return UserResponse(**updated_user)
@@ -2035,9 +4452,11 @@ async def delete_user(user_id: str, current_user: User = Depends(get_admin_user)
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    invalidate_cached_user(user_id)
     
     # Clean up user data
     await db.notifications.delete_many({"user_id": user_id})
+    await db.badge_progress.delete_one({"user_id": user_id})
     await db.mission_attempts.delete_many({"user_id": user_id})
     await db.documents.delete_many({"user_id": user_id})
     await db.evidences.delete_many({"user_id": user_id})
@@ -2048,7 +4467,10 @@ async def delete_user(user_id: str, current_user: User = Depends(get_admin_user)
 @api_router.post("/missions", response_model=Mission)
 async def create_mission(mission_data: MissionCreate, current_user: User = Depends(get_admin_user)):
     mission = Mission(**mission_data.dict(), created_by=current_user.id)
+    await validate_prerequisites(None, mission.prerequisite_missions)
+    mission.ordinal = await next_mission_ordinal()
     await db.missions.insert_one(mission.dict())
+    await mission_catalog_cache.changed(EligibilityChange(competence_areas={mission.competence_area.value}))
     return mission
 
 @api_router.get("/missions", response_model=List[Mission])
@@ -2058,60 +4480,65 @@ async def get_missions(
     skip: int = 0,
     limit: int = 100
 ):
-    query = {}
-    if competence_area:
-        query["competence_area"] = competence_area
-    if difficulty_level:
-        query["difficulty_level"] = difficulty_level
-    
-    missions = await db.missions.find(query).sort("position", 1).skip(skip).limit(limit).to_list(limit)
-    return [Mission(**mission) for mission in missions]
+    catalog = await get_mission_catalog()
+    missions = [
+        mission for mission in catalog.missions
+        if (not competence_area or mission.competence_area == competence_area)
+        and (not difficulty_level or mission.difficulty_level == difficulty_level)
+    ]
+    return missions[skip:skip + limit]
 
 @api_router.get("/missions/by-competence")
 async def get_missions_by_competence():
     """Get missions grouped by competence area"""
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$competence_area",
-                "missions": {"$push": "$$ROOT"},
-                "total": {"$sum": 1}
-            }
-        },
-        {"$sort": {"_id": 1}}
-    ]
-    
-    result = await db.missions.aggregate(pipeline).to_list(100)
+    catalog = await get_mission_catalog()
     
     grouped_missions = {}
-    for group in result:
-        competence = group["_id"]
-        missions = [Mission(**mission) for mission in group["missions"]]
+    for competence in sorted(catalog.ids_by_area):
+        missions = catalog.in_area(competence)
         grouped_missions[competence] = {
             "missions": missions,
-            "total": group["total"]
+            "total": len(missions)
         }
     
     return grouped_missions
 
 @api_router.put("/missions/{mission_id}", response_model=Mission)
 async def update_mission(mission_id: str, mission_data: MissionUpdate, current_user: User = Depends(get_admin_user)):
-    mission = await db.missions.find_one({"id": mission_id})
-    if not mission:
-        raise HTTPException(status_code=404, detail="Mission not found")
-    
     update_data = {k: v for k, v in mission_data.dict().items() if v is not None}
+    if "prerequisite_missions" in update_data:
+        await validate_prerequisites(mission_id, update_data["prerequisite_missions"])
+    previous = (await get_mission_catalog()).by_id.get(mission_id)
     if update_data:
-        await db.missions.update_one({"id": mission_id}, {"$set": update_data})
+        updated_mission = await db.missions.find_one_and_update(
+            {"id": mission_id}, {"$set": update_data}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        updated_mission = await db.missions.find_one({"id": mission_id})
+    if not updated_mission:
+        raise HTTPException(status_code=404, detail="Mission not found")
+    if update_data:
+        eligibility_change = None
+        if previous and "competence_area" in update_data:
+            eligibility_change = EligibilityChange(
+                mission_ids={mission_id},
+                competence_areas={previous.competence_area.value, updated_mission["competence_area"]}
+            )
+        await mission_catalog_cache.changed(eligibility_change)
+    if update_data.keys() & {"type", "competence_area"}:
+        await invalidate_mission_badge_progress(mission_id)
     
-    updated_mission = await db.missions.find_one({"id": mission_id})
     return Mission(**updated_mission)
 
 @api_router.delete("/missions/{mission_id}")
 async def delete_mission(mission_id: str, current_user: User = Depends(get_admin_user)):
-    result = await db.missions.delete_one({"id": mission_id})
-    if result.deleted_count == 0:
+    deleted = await db.missions.find_one_and_delete({"id": mission_id}, {"_id": 0, "competence_area": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Mission not found")
+    await mission_catalog_cache.changed(
+        EligibilityChange(mission_ids={mission_id}, competence_areas={deleted["competence_area"]})
+    )
+    await invalidate_mission_badge_progress(mission_id)
     return {"message": "Mission deleted successfully"}
 
 @api_router.get("/missions/{user_id}/with-status", response_model=List[MissionWithStatus])
@@ -2120,23 +4547,35 @@ async def get_missions_with_status(user_id: str, current_user: User = Depends(ge
     if current_user.role not in [UserRole.ADMIN, UserRole.REVISOR] and current_user.id != user_id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "completed_missions": 1, "failed_missions": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    missions = await db.missions.find().sort("position", 1).to_list(100)
-    completed_missions = user.get("completed_missions", [])
+    catalog = await get_mission_catalog()
+    completed_missions = set(user.get("completed_missions", []))
+    failed_missions = user.get("failed_missions", {})
+    
+    # Pending evidence for every open evidence-required mission, in one query
+    evidence_mission_ids = [
+        mission.id for mission in catalog.missions
+        if mission.evidence_required and mission.id not in completed_missions
+    ]
+    pending_review = set()
+    if evidence_mission_ids:
+        async for evidence in db.evidences.find(
+            {"user_id": user_id, "mission_id": {"$in": evidence_mission_ids}, "status": DocumentStatus.PENDING},
+            {"_id": 0, "mission_id": 1}
+        ):
+            pending_review.add(evidence["mission_id"])
     
     missions_with_status = []
-    for mission in missions:
-        mission_obj = Mission(**mission)
-        
+    for mission_obj in catalog.missions:
         # Determine status
         if mission_obj.id in completed_missions:
             status = MissionStatus.COMPLETED
-        elif await check_mission_cooldown(user_id, mission_obj.id):
+        elif not is_mission_in_cooldown(failed_missions, mission_obj.id):
             # Check prerequisites
-            prereq_met = all(prereq in completed_missions for prereq in mission_obj.prerequisite_missions)
+            prereq_met = catalog.prerequisites_met(mission_obj.id, completed_missions)
             status = MissionStatus.AVAILABLE if prereq_met else MissionStatus.LOCKED
         else:
             status = MissionStatus.LOCKED
@@ -2145,12 +4584,9 @@ async def get_missions_with_status(user_id: str, current_user: User = Depends(ge
         progress_percentage = 0.0
         if status == MissionStatus.COMPLETED:
             progress_percentage = 100.0
-        elif mission_obj.evidence_required:
-            # Check if evidence is pending review
-            evidence = await db.evidences.find_one({"user_id": user_id, "mission_id": mission_obj.id})
-            if evidence and evidence["status"] == "pending":
-                status = MissionStatus.IN_REVIEW
-                progress_percentage = 50.0
+        elif mission_obj.id in pending_review:
+            status = MissionStatus.IN_REVIEW
+            progress_percentage = 50.0
         
         missions_with_status.append(MissionWithStatus(
             **mission_obj.dict(),
@@ -2191,13 +4627,20 @@ async def check_mission_cooldown_status(mission_id: str, user_id: str, current_u
 async def complete_mission(
     mission_id: str, 
     completion: MissionCompletion, 
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    mission = await db.missions.find_one({"id": mission_id})
-    if not mission:
+    return await run_idempotent(
+        idempotency_key, current_user.id, request_fingerprint(f"complete:{mission_id}", completion),
+        lambda: complete_mission_for_user(mission_id, completion, current_user)
+    )
+
+async def complete_mission_for_user(mission_id: str, completion: MissionCompletion, current_user: User):
+    catalog = await get_mission_catalog()
+    mission_obj = catalog.by_id.get(mission_id)
+    if not mission_obj:
         raise HTTPException(status_code=404, detail="Mission not found")
     
-    mission_obj = Mission(**mission)
     user = current_user
     
     # Check if mission is already completed
@@ -2209,7 +4652,7 @@ async def complete_mission(
         raise HTTPException(status_code=400, detail="Mission is in cooldown period")
     
     # Check prerequisites
-    prereq_met = all(prereq in user.completed_missions for prereq in mission_obj.prerequisite_missions)
+    prereq_met = catalog.prerequisites_met(mission_id, set(user.completed_missions))
     if not prereq_met:
         raise HTTPException(status_code=400, detail="Prerequisites not met")
     
@@ -2282,46 +4725,12 @@ async def complete_mission(
         points_awarded = mission_obj.points_reward
         coins_awarded = mission_obj.coins_reward
         
-        # Update user
-        await db.users.update_one(
-            {"id": user.id},
-            {
-                "$push": {"completed_missions": mission_id},
-                "$inc": {
-                    "points": points_awarded,
-                    "coins": coins_awarded,
-                    "weekly_xp": points_awarded
-                },
-                "$set": {"updated_at": datetime.utcnow()}
-            }
-        )
-        
-        # Update streak
-        await update_user_streak(user.id)
-        
-        # Check for level up
-        updated_user = await db.users.find_one({"id": user.id})
-        updated_user_obj = User(**updated_user)
-        level_changed = await check_and_update_user_level(updated_user_obj)
-        
-        # Award badges
-        badges_awarded = await award_badges_to_user(updated_user_obj)
-        
-        # Create success notification
-        notification = Notification(
-            user_id=user.id,
-            type=NotificationType.MISSION_AVAILABLE,
-            title="¡Misión Completada!",
-            message=f"Has completado '{mission_obj.title}' y ganado {points_awarded} puntos y {coins_awarded} monedas.",
-            data={
-                "mission_id": mission_id,
-                "points_awarded": points_awarded,
-                "coins_awarded": coins_awarded,
-                "level_changed": level_changed,
-                "badges_awarded": len(badges_awarded)
-            }
-        )
-        await db.notifications.insert_one(notification.dict())
+        completion_result = await apply_mission_completion(user.id, mission_obj, notify=True)
+        if not completion_result:
+            raise HTTPException(status_code=400, detail="Mission already completed")
+        level_changed = completion_result["level_changed"]
+        badges_awarded = completion_result["badges_awarded"]
+        unlocked_missions = completion_result["unlocked_missions"]
         
         return {
             "success": True,
@@ -2330,6 +4739,7 @@ async def complete_mission(
             "coins_awarded": coins_awarded,
             "level_changed": level_changed,
             "badges_awarded": [badge.title for badge in badges_awarded],
+            "unlocked_missions": [{"id": mission.id, "title": mission.title} for mission in unlocked_missions],
             "message": f"¡Excelente! Has completado la misión y ganado {points_awarded} puntos y {coins_awarded} monedas."
         }
 
@@ -2388,6 +4798,8 @@ async def delete_event(event_id: str, current_user: User = Depends(get_admin_use
     # Clean up related data
     await db.eligibility_rules.delete_many({"event_id": event_id})
     await db.qr_tokens.delete_many({"event_id": event_id})
+    await db.event_eligibilities.delete_many({"event_id": event_id})
+    event_rule_index.invalidate()
     
     return {"message": "Event deleted successfully"}
 
@@ -2403,15 +4815,22 @@ async def create_eligibility_rule(
     if not event:
         raise HTTPException(status_code=404, detail="Event not found")
     
-    # Validate JSON condition
-    try:
-        json.loads(rule_data.condition)
-    except json.JSONDecodeError:
+    rule = EligibilityRule(event_id=event_id, **rule_data.dict())
+    
+    # Validate JSON condition and compile it up front
+    if compile_eligibility_rule(rule).condition is None:
+        compiled_rule_cache.pop(rule.id, None)
         raise HTTPException(status_code=400, detail="Invalid JSON condition")
     
-    rule = EligibilityRule(event_id=event_id, **rule_data.dict())
     await db.eligibility_rules.insert_one(rule.dict())
     
+    # Every stored result for this event was computed without the new rule
+    await db.event_eligibilities.update_many(
+        {"event_id": event_id},
+        {"$set": {"stale": True}, "$inc": {"revision": 1}}
+    )
+    event_rule_index.invalidate()
+    
     return rule
 
 @api_router.get("/events/{event_id}/eligibility-rules", response_model=List[EligibilityRule])
@@ -2429,16 +4848,41 @@ async def get_event_eligibility(
     if current_user.role not in [UserRole.ADMIN, UserRole.REVISOR] and current_user.id != user_id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
-    eligibility = await calculate_event_eligibility(user_id, event_id)
+    return await get_event_eligibility_cached(user_id, event_id)
+
+@api_router.post("/events/{event_id}/eligibility/bulk")
+async def bulk_event_eligibility(
+    event_id: str,
+    ciudad: Optional[str] = None,
+    cohorte: Optional[str] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    """Compute and store eligibility for a whole city/cohort in one pass"""
+    event = await db.events.find_one({"id": event_id}, {"_id": 0, "id": 1})
+    if not event:
+        raise HTTPException(status_code=404, detail="Event not found")
     
-    # Store eligibility calculation in database
-    await db.event_eligibilities.replace_one(
-        {"event_id": event_id, "user_id": user_id},
-        eligibility.dict(),
-        upsert=True
-    )
+    query = {}
+    if ciudad:
+        query["ciudad"] = ciudad
+    if cohorte:
+        query["cohorte"] = cohorte
     
-    return eligibility
+    return await calculate_bulk_event_eligibility(event_id, query)
+
+@api_router.get("/events/{event_id}/eligibility-histogram")
+async def get_event_eligibility_histogram(
+    event_id: str,
+    ciudad: Optional[str] = None,
+    cohorte: Optional[str] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    """Whole-population eligibility distribution for the events dashboard"""
+    event = await db.events.find_one({"id": event_id}, {"_id": 0, "id": 1})
+    if not event:
+        raise HTTPException(status_code=404, detail="Event not found")
+    
+    return await calculate_eligibility_histogram(event_id, ciudad, cohorte)
 
 @api_router.get("/events/{event_id}/suggestions/{user_id}")
 async def get_event_suggestions(
@@ -2457,9 +4901,14 @@ async def get_event_suggestions(
 @api_router.post("/qr-token/generate")
 async def generate_user_qr_token(
     event_id: Optional[str] = None, 
+    format: QRImageFormat = QRImageFormat.PNG,
+    box_size: int = 10,
     current_user: User = Depends(get_current_user)
 ):
     """Generate QR token for current user"""
+    if not 1 <= box_size <= QR_MAX_BOX_SIZE:
+        raise HTTPException(status_code=400, detail=f"box_size must be between 1 and {QR_MAX_BOX_SIZE}")
+    
     qr_token = await generate_qr_token(current_user.id, event_id)
     
     # Generate QR code image data
@@ -2471,21 +4920,12 @@ async def generate_user_qr_token(
         "expires_at": qr_token.expires_at.isoformat()
     }
     
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(json.dumps(qr_data))
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Convert to base64
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    qr_image = await qr_renderer.render_data_uri(json.dumps(qr_data), format, box_size)
     
     return {
         "qr_token": qr_token,
-        "qr_image": f"data:image/png;base64,{img_str}",
-        "expires_in_minutes": 5
+        "qr_image": qr_image,
+        "expires_in_minutes": QR_TOKEN_TTL_MINUTES
     }
 
 @api_router.post("/qr-token/verify")
@@ -2495,39 +4935,71 @@ async def verify_qr_token(token_data: dict, current_user: User = Depends(get_cur
     if not token:
         raise HTTPException(status_code=400, detail="Token is required")
     
-    qr_token = await db.qr_tokens.find_one({"token": token})
-    if not qr_token:
-        raise HTTPException(status_code=404, detail="Invalid token")
-    
-    qr_token_obj = QRToken(**qr_token)
-    
-    # Check if token is expired
-    if datetime.utcnow() > qr_token_obj.expires_at:
-        raise HTTPException(status_code=400, detail="Token expired")
-    
-    # Check if token is already used
-    if qr_token_obj.used:
+    result = (await claim_qr_tokens([QRScan(token=token)]))[0]
+    if not result["valid"]:
+        if result["reason"] == "invalid":
+            raise HTTPException(status_code=404, detail="Invalid token")
+        if result["reason"] == "expired":
+            raise HTTPException(status_code=400, detail="Token expired")
         raise HTTPException(status_code=400, detail="Token already used")
     
-    # Mark token as used
-    await db.qr_tokens.update_one(
-        {"id": qr_token_obj.id},
-        {
-            "$set": {
-                "used": True,
-                "used_at": datetime.utcnow()
-            }
-        }
-    )
-    
     return {
         "valid": True,
-        "user_info": qr_token_obj.user_info,
-        "status": qr_token_obj.status,
-        "event_id": qr_token_obj.event_id,
+        "user_info": result["user_info"],
+        "status": result["status"],
+        "event_id": result["event_id"],
+        "verification_time": datetime.utcnow().isoformat()
+    }
+
+@api_router.post("/qr-token/verify/batch")
+async def verify_qr_tokens_batch(batch: QRBatchVerify, current_user: User = Depends(get_current_user)):
+    """Verify and claim many tokens at once (door scanners); results follow the order of `tokens`"""
+    if len(batch.tokens) > QR_VERIFY_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {QR_VERIFY_BATCH_MAX} tokens per batch")
+    
+    results = await claim_qr_tokens([QRScan(token=token) for token in batch.tokens], batch.device_id)
+    return {
+        "results": results,
+        "accepted": sum(1 for result in results if result["valid"]),
         "verification_time": datetime.utcnow().isoformat()
     }
 
+@api_router.post("/qr-token/sync")
+async def sync_offline_qr_scans(sync: QROfflineSync, current_user: User = Depends(get_current_user)):
+    """Upload scans queued by an offline scanner.
+
+    Each token is valid if it had not expired at `scanned_at` and the sync
+    arrives within QR_OFFLINE_SYNC_WINDOW_HOURS of its expiry. When several
+    devices scanned the same token, the earliest scan wins (ties go to the
+    lowest device_id), regardless of the order in which devices sync.
+    """
+    if len(sync.scans) > QR_VERIFY_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {QR_VERIFY_BATCH_MAX} scans per sync")
+    
+    # Within one upload only the earliest scan of each token is claimed
+    now = datetime.utcnow()
+    by_scan_time = sorted(
+        range(len(sync.scans)),
+        key=lambda i: to_naive_utc(sync.scans[i].scanned_at) if sync.scans[i].scanned_at else now
+    )
+    first_scans: Dict[str, int] = {}
+    for i in by_scan_time:
+        first_scans.setdefault(sync.scans[i].token, i)
+    
+    claimed = await claim_qr_tokens([sync.scans[i] for i in first_scans.values()], sync.device_id, offline=True)
+    claimed_by_index = dict(zip(first_scans.values(), claimed))
+    # One result per uploaded scan, in upload order, so the scanner can zip them with its queue
+    results = [
+        claimed_by_index.get(i) or {"token": scan.token, "valid": False, "reason": "duplicate_in_batch"}
+        for i, scan in enumerate(sync.scans)
+    ]
+    return {
+        "device_id": sync.device_id,
+        "results": results,
+        "accepted": sum(1 for result in results if result["valid"]),
+        "synced_at": datetime.utcnow().isoformat()
+    }
+
 # Document and Evidence routes
 @api_router.post("/documents/upload")
 async def upload_document(
@@ -2591,6 +5063,39 @@ async def get_user_documents(
     documents = await db.documents.find(query).to_list(100)
     return [Document(**doc) for doc in documents]
 
+@api_router.post("/documents/{document_id}/review")
+async def review_document(
+    document_id: str,
+    review_data: EvidenceReview,
+    current_user: User = Depends(get_reviewer_user)
+):
+    """Review an uploaded user document"""
+    document = await db.documents.find_one({"id": document_id})
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    await db.documents.update_one(
+        {"id": document_id},
+        {
+            "$set": {
+                "status": review_data.status,
+                "reviewed_by": current_user.id,
+                "review_notes": review_data.review_notes,
+                "reviewed_at": datetime.utcnow()
+            }
+        }
+    )
+    
+    # Approving or revoking a document changes document-based eligibility rules
+    was_approved = document["status"] == DocumentStatus.APPROVED
+    if was_approved != (review_data.status == DocumentStatus.APPROVED):
+        await invalidate_user_eligibility(
+            document["user_id"],
+            EligibilityChange(document_types={document["document_type"]})
+        )
+    
+    return {"success": True, "message": f"Document marked as {review_data.status.value}"}
+
 @api_router.post("/evidences/upload")
 async def upload_evidence(
     mission_id: str = Form(...),
@@ -2601,8 +5106,7 @@ async def upload_evidence(
 ):
     """Upload mission evidence"""
     # Validate mission exists
-    mission = await db.missions.find_one({"id": mission_id})
-    if not mission:
+    if mission_id not in (await get_mission_catalog()).by_id:
         raise HTTPException(status_code=404, detail="Mission not found")
     
     # Validate file type
@@ -2647,13 +5151,14 @@ async def get_pending_evidences(
     ).skip(skip).limit(limit).to_list(limit)
     
     # Enrich with user and mission data
+    catalog = await get_mission_catalog()
     enriched_evidences = []
     for evidence in evidences:
         evidence_obj = Evidence(**evidence)
         
         # Get user info
         user = await db.users.find_one({"id": evidence_obj.user_id})
-        mission = await db.missions.find_one({"id": evidence_obj.mission_id})
+        mission = catalog.by_id.get(evidence_obj.mission_id)
         
         enriched_evidences.append({
             "evidence": evidence_obj,
@@ -2663,8 +5168,8 @@ async def get_pending_evidences(
                 "emprendimiento": user["nombre_emprendimiento"] if user else ""
             },
             "mission": {
-                "title": mission["title"] if mission else "Unknown Mission",
-                "competence_area": mission["competence_area"] if mission else ""
+                "title": mission.title if mission else "Unknown Mission",
+                "competence_area": mission.competence_area if mission else ""
             }
         })
     
@@ -2699,29 +5204,10 @@ async def review_evidence(
         mission_id = evidence["mission_id"]
         user_id = evidence["user_id"]
         
-        # Check if mission is already completed
-        user = await db.users.find_one({"id": user_id})
-        if mission_id not in user["completed_missions"]:
-            mission = await db.missions.find_one({"id": mission_id})
-            mission_obj = Mission(**mission)
-            
-            # Award points and coins
-            await db.users.update_one(
-                {"id": user_id},
-                {
-                    "$push": {"completed_missions": mission_id},
-                    "$inc": {
-                        "points": mission_obj.points_reward,
-                        "coins": mission_obj.coins_reward
-                    },
-                    "$set": {"updated_at": datetime.utcnow()}
-                }
-            )
-            
-            # Update streak and check level up
-            await update_user_streak(user_id)
-            updated_user = await db.users.find_one({"id": user_id})
-            await check_and_update_user_level(User(**updated_user))
+        mission = (await get_mission_catalog()).by_id.get(mission_id)
+        if mission:
+            # No-op if the mission was already completed
+            await apply_mission_completion(user_id, mission)
     
     # Create notification
     notification_type = NotificationType.EVIDENCE_APPROVED if review_data.status == DocumentStatus.APPROVED else NotificationType.EVIDENCE_REJECTED
@@ -2736,7 +5222,7 @@ async def review_evidence(
             "review_notes": review_data.review_notes
         }
     )
-    await db.notifications.insert_one(notification.dict())
+    await publish_notification(notification)
     
     return {
         "success": True,
@@ -2744,9 +5230,21 @@ async def review_evidence(
     }
 
 # Enhanced Reward routes with redemption system
+# Pipeline stage recomputing a reward's stored is_available flag from its stock
+REWARD_AVAILABILITY_STAGE = {"$set": {
+    "is_available": {"$or": [{"$eq": ["$stock", -1]}, {"$lt": ["$stock_consumed", "$stock"]}]}
+}}
+
+async def backfill_reward_availability():
+    """Set is_available on rewards stored before the flag existed"""
+    result = await db.rewards.update_many({"is_available": {"$exists": False}}, [REWARD_AVAILABILITY_STAGE])
+    if result.modified_count:
+        print(f"Backfilled is_available on {result.modified_count} rewards")
+
 @api_router.post("/rewards", response_model=Reward)
 async def create_reward(reward_data: RewardCreate, current_user: User = Depends(get_admin_user)):
     reward = Reward(**reward_data.dict())
+    reward.is_available = reward.stock == -1 or reward.stock_consumed < reward.stock
     await db.rewards.insert_one(reward.dict())
     return reward
 
@@ -2769,7 +5267,7 @@ async def get_rewards(
             {"available_until": {"$gte": datetime.utcnow()}}
         ]
         # Also check stock
-        query["$where"] = "this.stock == -1 || this.stock > this.stock_consumed"
+        query["is_available"] = True
     
     rewards = await db.rewards.find(query).skip(skip).limit(limit).to_list(limit)
     return [Reward(**reward) for reward in rewards]
@@ -2789,7 +5287,11 @@ async def update_reward(reward_id: str, reward_data: RewardUpdate, current_user:
     
     update_data = {k: v for k, v in reward_data.dict().items() if v is not None}
     if update_data:
-        await db.rewards.update_one({"id": reward_id}, {"$set": update_data})
+        # Values are literals so strings starting with "$" are not read as field paths
+        await db.rewards.update_one(
+            {"id": reward_id},
+            [{"$set": {k: {"$literal": v} for k, v in update_data.items()}}, REWARD_AVAILABILITY_STAGE]
+        )
     
     updated_reward = await db.rewards.find_one({"id": reward_id})
     return Reward(**updated_reward)
@@ -2801,9 +5303,26 @@ async def delete_reward(reward_id: str, current_user: User = Depends(get_admin_u
         raise HTTPException(status_code=404, detail="Reward not found")
     return {"message": "Reward deleted successfully"}
 
+async def release_reward_stock(reward_id: str):
+    """Give back a unit reserved by a redemption that did not go through"""
+    await db.rewards.update_one(
+        {"id": reward_id, "stock_consumed": {"$gt": 0}},
+        [{"$set": {"stock_consumed": {"$subtract": ["$stock_consumed", 1]}}}, REWARD_AVAILABILITY_STAGE]
+    )
+
 @api_router.post("/rewards/{reward_id}/redeem")
-async def redeem_reward(reward_id: str, current_user: User = Depends(get_current_user)):
+async def redeem_reward(
+    reward_id: str,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Redeem a reward with coins"""
+    return await run_idempotent(
+        idempotency_key, current_user.id, request_fingerprint(f"redeem:{reward_id}"),
+        lambda: redeem_reward_for_user(reward_id, current_user)
+    )
+
+async def redeem_reward_for_user(reward_id: str, current_user: User):
     reward = await db.rewards.find_one({"id": reward_id})
     if not reward:
         raise HTTPException(status_code=404, detail="Reward not found")
@@ -2814,51 +5333,57 @@ async def redeem_reward(reward_id: str, current_user: User = Depends(get_current
     if reward_obj.available_until and datetime.utcnow() > reward_obj.available_until:
         raise HTTPException(status_code=400, detail="Reward has expired")
     
-    # Check stock
+    # Check stock (fast path; the reservation below is what enforces it)
     if reward_obj.stock != -1 and reward_obj.stock_consumed >= reward_obj.stock:
         raise HTTPException(status_code=400, detail="Reward is out of stock")
     
-    # Check user has enough coins
-    if current_user.coins < reward_obj.coins_cost:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Insufficient coins. You need {reward_obj.coins_cost} coins but have {current_user.coins}"
-        )
-    
-    # Generate redemption code
-    redemption_code = secrets.token_hex(8).upper()
-    
-    # Create redemption record
-    redemption = RewardRedemption(
-        user_id=current_user.id,
-        reward_id=reward_id,
-        redemption_code=redemption_code
+    # Reserve one unit only while stock remains
+    reserved = await db.rewards.update_one(
+        {
+            "id": reward_id,
+            "$expr": {"$or": [{"$eq": ["$stock", -1]}, {"$lt": ["$stock_consumed", "$stock"]}]}
+        },
+        [{"$set": {"stock_consumed": {"$add": ["$stock_consumed", 1]}}}, REWARD_AVAILABILITY_STAGE]
     )
+    if reserved.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Reward is out of stock")
     
-    # Generate QR code for physical redemption if needed
-    if reward_obj.reward_type in [RewardType.DISCOUNT, RewardType.CONSULTATION, RewardType.EQUIPMENT]:
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(redemption_code)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        redemption.qr_code_data = img_str
-    
-    await db.reward_redemptions.insert_one(redemption.dict())
-    
-    # Update user coins and reward stock
-    await db.users.update_one(
-        {"id": current_user.id},
+    # Charge coins only while the balance covers the cost
+    charged = await db.users.update_one(
+        {"id": current_user.id, "coins": {"$gte": reward_obj.coins_cost}},
         {"$inc": {"coins": -reward_obj.coins_cost}}
     )
+    invalidate_cached_user(current_user.id)
+    if charged.modified_count == 0:
+        await release_reward_stock(reward_id)
+        user = await db.users.find_one({"id": current_user.id}, {"_id": 0, "coins": 1})
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Insufficient coins. You need {reward_obj.coins_cost} coins but have {user.get('coins', 0) if user else 0}"
+        )
     
-    await db.rewards.update_one(
-        {"id": reward_id},
-        {"$inc": {"stock_consumed": 1}}
-    )
+    try:
+        # Generate redemption code
+        redemption_code = secrets.token_hex(8).upper()
+        
+        # Create redemption record
+        redemption = RewardRedemption(
+            user_id=current_user.id,
+            reward_id=reward_id,
+            redemption_code=redemption_code
+        )
+        
+        # Generate QR code for physical redemption if needed
+        if reward_obj.reward_type in [RewardType.DISCOUNT, RewardType.CONSULTATION, RewardType.EQUIPMENT]:
+            redemption.qr_code_data = await qr_renderer.render(redemption_code)
+        
+        await db.reward_redemptions.insert_one(redemption.dict())
+    except BaseException:
+        # Undo the charge and the reservation so nothing is lost without a redemption
+        await db.users.update_one({"id": current_user.id}, {"$inc": {"coins": reward_obj.coins_cost}})
+        invalidate_cached_user(current_user.id)
+        await release_reward_stock(reward_id)
+        raise
     
     # Create notification
     notification = Notification(
@@ -2872,7 +5397,7 @@ async def redeem_reward(reward_id: str, current_user: User = Depends(get_current
             "reward_title": reward_obj.title
         }
     )
-    await db.notifications.insert_one(notification.dict())
+    await publish_notification(notification)
     
     return {
         "success": True,
@@ -3003,7 +5528,14 @@ async def join_league(league_id: str, current_user: User = Depends(get_current_u
 @api_router.post("/badges", response_model=Badge)
 async def create_badge(badge_data: Badge, current_user: User = Depends(get_admin_user)):
     """Create a new badge"""
+    try:
+        parse_badge_condition(badge_data.condition)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     await db.badges.insert_one(badge_data.dict())
+    badge_rule_registry.invalidate()
+    # Existing users who already qualify get the badge without waiting for their next mission
+    await start_badge_backfill(badge_data.id)
     return badge_data
 
 @api_router.get("/badges", response_model=List[Badge])
@@ -3021,6 +5553,33 @@ async def get_badges(
     badges = await db.badges.find(query).to_list(100)
     return [Badge(**badge) for badge in badges]
 
+@api_router.get("/badges/progress/{user_id}")
+async def get_user_badge_progress(user_id: str, current_user: User = Depends(get_current_user)):
+    """Progress towards every badge, e.g. 3 of 5 missions"""
+    if current_user.role not in [UserRole.ADMIN, UserRole.REVISOR] and current_user.id != user_id:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    
+    progress = await get_badge_progress(user_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    catalog = await get_mission_catalog()
+    badges = []
+    for badge, predicate in await badge_rule_registry.get_rules():
+        current = predicate.current(progress, catalog)
+        target = predicate.target(catalog)
+        met = predicate.is_met(progress, catalog)
+        badges.append({
+            "badge_id": badge.id,
+            "title": badge.title,
+            "metric": predicate.metric,
+            "current": current,
+            "target": target,
+            "progress": 1.0 if met else round(min(current / target, 1.0), 3) if target else 0.0
+        })
+    
+    return {"user_id": user_id, "counters": progress.dict(exclude={"counted_missions"}), "badges": badges}
+
 @api_router.get("/badges/user/{user_id}")
 async def get_user_badges(user_id: str, current_user: User = Depends(get_current_user)):
     """Get user's earned badges"""
@@ -3041,6 +5600,24 @@ async def get_user_badges(user_id: str, current_user: User = Depends(get_current
     
     return enriched_badges
 
+@api_router.post("/admin/badges/{badge_id}/backfill")
+async def backfill_badge(badge_id: str, current_user: User = Depends(get_admin_user)):
+    """Grant a badge to every user who already qualifies, resuming an unfinished sweep"""
+    badge = await db.badges.find_one({"id": badge_id})
+    if not badge:
+        raise HTTPException(status_code=404, detail="Badge not found")
+    
+    job = await start_badge_backfill(badge_id)
+    return badge_backfill_report(job)
+
+@api_router.get("/admin/badge-backfills/{job_id}")
+async def get_badge_backfill(job_id: str, current_user: User = Depends(get_admin_user)):
+    """Progress and throughput of a badge backfill"""
+    job = await db.badge_backfill_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Backfill job not found")
+    return badge_backfill_report(BadgeBackfillJob(**job))
+
 # Notification routes
 @api_router.get("/notifications")
 async def get_notifications(
@@ -3081,62 +5658,120 @@ async def mark_all_notifications_read(current_user: User = Depends(get_current_u
     return {"success": True}
 
 # Admin and Analytics routes
+ADMIN_STATS_WEEKS = 8
+ADMIN_STATS_TOP = 10
+
+def admin_user_stats_pipeline(now: datetime) -> List[dict]:
+    """Single pass over users producing every per-user figure of /admin/stats"""
+    week_ago = now - timedelta(days=7)
+    month_ago = now - timedelta(days=30)
+    trend_start = now - timedelta(weeks=ADMIN_STATS_WEEKS)
+    completed = {"$ifNull": ["$completed_missions", []]}
+    week_ms = int(timedelta(weeks=1).total_seconds() * 1000)
+
+    def active_since(since: datetime) -> dict:
+        return {"$sum": {"$cond": [{"$gte": ["$last_activity", since]}, 1, 0]}}
+
+    return [
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": None,
+                    "users": {"$sum": 1},
+                    "completed_missions": {"$sum": {"$size": completed}},
+                    "points": {"$sum": {"$ifNull": ["$points", 0]}},
+                    "coins": {"$sum": {"$ifNull": ["$coins", 0]}},
+                    "active_week": active_since(week_ago),
+                    "active_month": active_since(month_ago)
+                }}
+            ],
+            "mission_completions": [
+                {"$unwind": "$completed_missions"},
+                {"$group": {"_id": "$completed_missions", "count": {"$sum": 1}}}
+            ],
+            "by_city": [
+                {"$group": {"_id": {"$ifNull": ["$ciudad", "Unknown"]}, "count": {"$sum": 1}}}
+            ],
+            # Week i covers [now - (i+1) weeks, now - i weeks)
+            "weekly": [
+                {"$match": {"last_activity": {"$gte": trend_start, "$lt": now}}},
+                {"$group": {
+                    "_id": {"$subtract": [
+                        {"$ceil": {"$divide": [{"$subtract": [now, "$last_activity"]}, week_ms]}}, 1
+                    ]},
+                    "count": {"$sum": 1}
+                }}
+            ],
+            "top_performers": [
+                {"$sort": {"points": -1, "id": 1}},
+                {"$limit": ADMIN_STATS_TOP},
+                {"$project": {
+                    "_id": 0,
+                    "id": 1,
+                    "nombre": 1,
+                    "apellido": 1,
+                    "nombre_emprendimiento": 1,
+                    "points": {"$ifNull": ["$points", 0]},
+                    "completed_missions": {"$size": completed},
+                    "current_streak": {"$ifNull": ["$current_streak", 0]}
+                }}
+            ]
+        }}
+    ]
+
+def reward_redemption_stats_pipeline() -> List[dict]:
+    """Redemptions grouped per reward and joined to the reward's title and cost"""
+    return [
+        {"$group": {"_id": "$reward_id", "redemptions": {"$sum": 1}}},
+        {"$lookup": {
+            "from": "rewards",
+            "localField": "_id",
+            "foreignField": "id",
+            "as": "reward"
+        }},
+        {"$project": {
+            "redemptions": 1,
+            "title": {"$arrayElemAt": ["$reward.title", 0]},
+            # Redemptions of deleted rewards still count, but spend nothing
+            "coins_cost": {"$ifNull": [{"$arrayElemAt": ["$reward.coins_cost", 0]}, 0]}
+        }},
+        {"$sort": {"redemptions": -1, "_id": 1}}
+    ]
+
 @api_router.get("/admin/stats", response_model=AdminStats)
 async def get_admin_stats(current_user: User = Depends(get_admin_user)):
     """Get comprehensive admin statistics"""
-    # Basic counts
-    total_users = await db.users.count_documents({})
-    total_missions = await db.missions.count_documents({})
-    
-    # Calculate total completed missions
-    users = await db.users.find({}).to_list(10000)
-    total_completed_missions = sum(len(user.get("completed_missions", [])) for user in users)
-    
-    # Calculate total points and coins awarded
-    total_points_awarded = sum(user.get("points", 0) for user in users)
-    total_coins_awarded = sum(user.get("coins", 0) for user in users)
-    
-    # Active users (last week and month)
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    month_ago = datetime.utcnow() - timedelta(days=30)
-    
-    active_users_last_week = await db.users.count_documents({
-        "last_activity": {"$gte": week_ago}
-    })
-    
-    active_users_last_month = await db.users.count_documents({
-        "last_activity": {"$gte": month_ago}
-    })
+    now = datetime.utcnow()
+    catalog, user_stats, redemption_groups, total_events, upcoming_events = await asyncio.gather(
+        get_mission_catalog(),
+        db.users.aggregate(admin_user_stats_pipeline(now)).to_list(1),
+        db.reward_redemptions.aggregate(reward_redemption_stats_pipeline()).to_list(None),
+        db.events.count_documents({}),
+        db.events.count_documents({"date": {"$gte": now}})
+    )
+    facets = user_stats[0]
+    totals = facets["totals"][0] if facets["totals"] else {}
+    total_users = totals.get("users", 0)
+    mission_completion_counts = {row["_id"]: row["count"] for row in facets["mission_completions"]}
     
     # Most popular missions
-    mission_completion_counts = {}
-    for user in users:
-        completed_missions = user.get("completed_missions", [])
-        for mission_id in completed_missions:
-            mission_completion_counts[mission_id] = mission_completion_counts.get(mission_id, 0) + 1
-    
-    # Get mission details for top missions
     most_popular_missions = []
-    for mission_id, count in sorted(mission_completion_counts.items(), key=lambda x: x[1], reverse=True)[:10]:
-        mission = await db.missions.find_one({"id": mission_id})
+    for mission_id, count in sorted(mission_completion_counts.items(), key=lambda x: x[1], reverse=True)[:ADMIN_STATS_TOP]:
+        mission = catalog.by_id.get(mission_id)
         if mission:
             most_popular_missions.append({
-                "mission": Mission(**mission),
+                "mission": mission,
                 "completion_count": count
             })
     
     # Completion rate by competence area
     competence_stats = {}
     for competence in CompetenceArea:
-        area_missions = await db.missions.find({"competence_area": competence.value}).to_list(1000)
-        total_area_missions = len(area_missions)
+        area_mission_ids = catalog.area_ids(competence.value)
+        total_area_missions = len(area_mission_ids)
         
         if total_area_missions > 0:
-            area_mission_ids = [m["id"] for m in area_missions]
-            completed_in_area = sum(
-                len([m for m in user.get("completed_missions", []) if m in area_mission_ids])
-                for user in users
-            )
+            completed_in_area = sum(mission_completion_counts.get(mission_id, 0) for mission_id in area_mission_ids)
             
             # Calculate completion rate
             possible_completions = total_users * total_area_missions
@@ -3144,24 +5779,17 @@ async def get_admin_stats(current_user: User = Depends(get_admin_user)):
             competence_stats[competence.value] = completion_rate
     
     # User distribution by city
-    user_distribution_by_city = {}
-    for user in users:
-        city = user.get("ciudad", "Unknown")
-        user_distribution_by_city[city] = user_distribution_by_city.get(city, 0) + 1
+    user_distribution_by_city = {row["_id"]: row["count"] for row in facets["by_city"]}
     
-    # Weekly engagement trend (simplified)
+    # Weekly engagement trend
+    weekly_counts = {int(row["_id"]): row["count"] for row in facets["weekly"]}
     weekly_engagement_trend = []
-    for i in range(8):  # Last 8 weeks
-        week_start = datetime.utcnow() - timedelta(weeks=i+1)
-        week_end = datetime.utcnow() - timedelta(weeks=i)
-        
-        active_users_week = await db.users.count_documents({
-            "last_activity": {"$gte": week_start, "$lt": week_end}
-        })
-        
+    for i in range(ADMIN_STATS_WEEKS):
+        week_start = now - timedelta(weeks=i+1)
+        week_end = now - timedelta(weeks=i)
         weekly_engagement_trend.append({
             "week": f"Week -{i}",
-            "active_users": active_users_week,
+            "active_users": weekly_counts.get(i, 0),
             "date_range": {
                 "start": week_start.isoformat(),
                 "end": week_end.isoformat()
@@ -3169,48 +5797,46 @@ async def get_admin_stats(current_user: User = Depends(get_admin_user)):
         })
     
     # Top performers
-    top_performers = sorted(users, key=lambda x: x.get("points", 0), reverse=True)[:10]
-    top_performers_data = []
-    for user in top_performers:
-        top_performers_data.append({
+    top_performers_data = [
+        {
             "user": {
                 "id": user["id"],
                 "nombre": user["nombre"],
                 "apellido": user["apellido"],
                 "emprendimiento": user["nombre_emprendimiento"]
             },
-            "points": user.get("points", 0),
-            "completed_missions": len(user.get("completed_missions", [])),
-            "current_streak": user.get("current_streak", 0)
-        })
+            "points": user["points"],
+            "completed_missions": user["completed_missions"],
+            "current_streak": user["current_streak"]
+        }
+        for user in facets["top_performers"]
+    ]
     
     # Event attendance stats (placeholder)
     event_attendance_stats = {
-        "total_events": await db.events.count_documents({}),
-        "upcoming_events": await db.events.count_documents({"date": {"$gte": datetime.utcnow()}}),
+        "total_events": total_events,
+        "upcoming_events": upcoming_events,
         "average_registration_rate": 0.75  # This would need more complex calculation
     }
     
     # Reward redemption stats
-    reward_redemptions = await db.reward_redemptions.find({}).to_list(10000)
     reward_redemption_stats = {
-        "total_redemptions": len(reward_redemptions),
-        "total_coins_spent": sum(
-            reward["coins_cost"] for redemption in reward_redemptions
-            for reward in [await db.rewards.find_one({"id": redemption["reward_id"]})]
-            if reward
-        ),
-        "most_popular_rewards": {}  # Would need aggregation
+        "total_redemptions": sum(group["redemptions"] for group in redemption_groups),
+        "total_coins_spent": sum(group["redemptions"] * group["coins_cost"] for group in redemption_groups),
+        "most_popular_rewards": {
+            group["_id"]: {"title": group.get("title"), "redemptions": group["redemptions"]}
+            for group in redemption_groups[:ADMIN_STATS_TOP]
+        }
     }
     
     return AdminStats(
         total_users=total_users,
-        total_missions=total_missions,
-        total_completed_missions=total_completed_missions,
-        total_points_awarded=total_points_awarded,
-        total_coins_awarded=total_coins_awarded,
-        active_users_last_week=active_users_last_week,
-        active_users_last_month=active_users_last_month,
+        total_missions=len(catalog.missions),
+        total_completed_missions=totals.get("completed_missions", 0),
+        total_points_awarded=totals.get("points", 0),
+        total_coins_awarded=totals.get("coins", 0),
+        active_users_last_week=totals.get("active_week", 0),
+        active_users_last_month=totals.get("active_month", 0),
         most_popular_missions=most_popular_missions,
         completion_rate_by_competence=competence_stats,
         user_distribution_by_city=user_distribution_by_city,
@@ -3220,6 +5846,23 @@ async def get_admin_stats(current_user: User = Depends(get_admin_user)):
         reward_redemption_stats=reward_redemption_stats
     )
 
+@api_router.get("/admin/indexes")
+async def get_admin_indexes(current_user: User = Depends(get_admin_user)):
+    """Report declared indexes, what exists in MongoDB and how often each index is used"""
+    return await get_index_report()
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(current_user: User = Depends(get_admin_user)):
+    """In-process runtime metrics for this API worker"""
+    return {
+        "password_hashing": password_pool.stats(),
+        "user_cache": user_principal_cache.stats(),
+        "qr_renderer": qr_renderer.stats(),
+        "mission_catalog": mission_catalog_cache.stats(),
+        "outbox": await outbox.stats(),
+        "idempotency": idempotency_store.stats()
+    }
+
 @api_router.get("/admin/impact-metrics")
 async def get_impact_metrics(
     period: str = "monthly",
@@ -3309,8 +5952,7 @@ async def get_impact_metrics(
 
 async def get_networking_mission_ids():
     """Helper function to get networking mission IDs"""
-    missions = await db.missions.find({"type": "networking_task"}).to_list(100)
-    return [mission["id"] for mission in missions]
+    return list((await get_mission_catalog()).type_ids(MissionType.NETWORKING_TASK.value))
 
 @api_router.get("/admin/export/users")
 async def export_users(
@@ -3349,25 +5991,22 @@ async def export_missions_progress(
     current_user: User = Depends(get_admin_user)
 ):
     """Export mission progress data"""
-    query = {}
-    if competence_area:
-        query["competence_area"] = competence_area
-    
-    missions = await db.missions.find(query).to_list(1000)
+    catalog = await get_mission_catalog()
+    missions = catalog.in_area(competence_area.value) if competence_area else catalog.missions
     users = await db.users.find({}).to_list(10000)
     
     if format.lower() == "csv":
         csv_data = "Mission ID,Mission Title,Competence Area,Total Completions,Completion Rate,Avg Score\n"
         
         for mission in missions:
-            completions = sum(1 for user in users if mission["id"] in user.get("completed_missions", []))
+            completions = sum(1 for user in users if mission.id in user.get("completed_missions", []))
             completion_rate = (completions / len(users) * 100) if users else 0
             
             # Get average score for quiz missions
-            attempts = await db.mission_attempts.find({"mission_id": mission["id"], "status": "success"}).to_list(1000)
+            attempts = await db.mission_attempts.find({"mission_id": mission.id, "status": "success"}).to_list(1000)
             avg_score = sum(attempt.get("score", 0) for attempt in attempts) / len(attempts) if attempts else 0
             
-            csv_data += f"{mission['id']},{mission['title']},{mission['competence_area']},{completions},{completion_rate:.1f},{avg_score:.1f}\n"
+            csv_data += f"{mission.id},{mission.title},{mission.competence_area.value},{completions},{completion_rate:.1f},{avg_score:.1f}\n"
         
         return JSONResponse(
             content={"csv_data": csv_data},
@@ -3382,6 +6021,7 @@ async def reset_weekly_leagues(current_user: User = Depends(get_admin_user)):
     """Reset weekly XP for all users and create new leagues"""
     # Reset weekly XP for all users
     await db.users.update_many({}, {"$set": {"weekly_xp": 0}})
+    user_principal_cache.clear()
     
     # End current leagues
     await db.leagues.update_many(
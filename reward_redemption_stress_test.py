@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Stress test for reward redemption.
+
+Fires thousands of concurrent redemptions at a reward with limited stock and
+checks that the backend never oversells it and never drives a user's coins
+negative:
+- successful redemptions <= stock
+- reward.stock_consumed == successful redemptions
+- every user's coins == starting coins - cost * their successful redemptions
+"""
+import os
+import sys
+import time
+import uuid
+import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+# Defaults to a local backend: the test creates users and drains stock wherever it points
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8001/api")
+
+STOCK = int(os.environ.get("STRESS_STOCK", 25))
+COINS_COST = 10
+USERS = int(os.environ.get("STRESS_USERS", 40))
+# Each user can afford this many redemptions, so coins run out as well as stock
+STARTING_COINS = COINS_COST * 3 + 5
+REQUESTS = int(os.environ.get("STRESS_REQUESTS", 2000))
+CONCURRENCY = int(os.environ.get("STRESS_CONCURRENCY", 64))
+
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=CONCURRENCY))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=CONCURRENCY))
+
+def post_with_retry(url: str, **kwargs) -> requests.Response:
+    """POST, waiting out 503 Retry-After responses from the password hashing pool"""
+    while True:
+        response = session.post(url, **kwargs)
+        if response.status_code != 503:
+            return response
+        time.sleep(int(response.headers.get("Retry-After", 1)))
+
+def login(cedula: str, password: str) -> Dict[str, Any]:
+    response = post_with_retry(f"{BACKEND_URL}/login", json={"cedula": cedula, "password": password})
+    response.raise_for_status()
+    return response.json()
+
+def create_reward(admin_headers: Dict[str, str]) -> Dict[str, Any]:
+    reward_data = {
+        "title": f"Stress Reward {uuid.uuid4().hex[:6]}",
+        "description": "Limited stock reward for the redemption stress test",
+        "reward_type": "discount",
+        "value": "10%",
+        "coins_cost": COINS_COST,
+        "stock": STOCK
+    }
+    response = session.post(f"{BACKEND_URL}/rewards", headers=admin_headers, json=reward_data)
+    response.raise_for_status()
+    return response.json()
+
+def create_user(admin_headers: Dict[str, str]) -> Dict[str, Any]:
+    unique_id = uuid.uuid4().hex[:8]
+    user_data = {
+        "nombre": "Stress",
+        "apellido": f"User {unique_id}",
+        "cedula": f"9{int(unique_id, 16) % 10**9:09d}",
+        "email": f"stress.{unique_id}@example.com",
+        "nombre_emprendimiento": f"Stress {unique_id}",
+        "password": "stresspassword123"
+    }
+    response = post_with_retry(f"{BACKEND_URL}/register", json=user_data)
+    response.raise_for_status()
+    user = response.json()
+
+    response = session.put(f"{BACKEND_URL}/users/{user['id']}", headers=admin_headers, json={"coins": STARTING_COINS})
+    response.raise_for_status()
+
+    token = login(user_data["cedula"], user_data["password"])["access_token"]
+    return {"id": user["id"], "headers": {"Authorization": f"Bearer {token}"}}
+
+def redeem(reward_id: str, user: Dict[str, Any]) -> tuple:
+    try:
+        response = session.post(f"{BACKEND_URL}/rewards/{reward_id}/redeem", headers=user["headers"])
+        return user["id"], response.status_code
+    except requests.RequestException as e:
+        return user["id"], str(e)
+
+def cleanup(admin_headers: Dict[str, str], reward_id: Optional[str], users: List[Dict[str, Any]]):
+    for user in users:
+        session.delete(f"{BACKEND_URL}/users/{user['id']}", headers=admin_headers)
+    if reward_id:
+        session.delete(f"{BACKEND_URL}/rewards/{reward_id}", headers=admin_headers)
+
+def run_stress_test() -> bool:
+    print(f"🔥 Reward redemption stress test against {BACKEND_URL}")
+    print(f"   stock={STOCK} users={USERS} requests={REQUESTS} concurrency={CONCURRENCY}\n")
+
+    admin_headers = {"Authorization": f"Bearer {login('0000000000', 'admin')['access_token']}"}
+    reward = create_reward(admin_headers)
+    users: List[Dict[str, Any]] = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            users = list(pool.map(lambda _: create_user(admin_headers), range(USERS)))
+        print(f"Created reward {reward['id']} and {len(users)} users with {STARTING_COINS} coins each")
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            results = list(pool.map(lambda i: redeem(reward["id"], users[i % len(users)]), range(REQUESTS)))
+        elapsed = time.time() - started
+
+        statuses = Counter(status for _, status in results)
+        successes = Counter(user_id for user_id, status in results if status == 200)
+        total_successes = sum(successes.values())
+        print(f"Sent {REQUESTS} redemptions in {elapsed:.2f}s ({REQUESTS / elapsed:.0f} req/s)")
+        print(f"Status codes: {dict(statuses)}\n")
+
+        failures = []
+        if total_successes > STOCK:
+            failures.append(f"Oversold: {total_successes} redemptions for a stock of {STOCK}")
+
+        reward_after = session.get(f"{BACKEND_URL}/rewards/{reward['id']}").json()
+        if reward_after["stock_consumed"] != total_successes:
+            failures.append(
+                f"stock_consumed is {reward_after['stock_consumed']} but {total_successes} redemptions succeeded"
+            )
+
+        for user in users:
+            coins = session.get(f"{BACKEND_URL}/users/{user['id']}", headers=admin_headers).json()["coins"]
+            expected = STARTING_COINS - COINS_COST * successes[user["id"]]
+            if coins < 0 or coins != expected:
+                failures.append(f"User {user['id']} has {coins} coins, expected {expected}")
+
+        if failures:
+            print("❌ FAIL:")
+            for failure in failures:
+                print(f"   {failure}")
+            return False
+
+        print(f"✅ PASS: {total_successes}/{STOCK} units redeemed, no oversell and no negative balances")
+        return True
+    finally:
+        cleanup(admin_headers, reward["id"], users)
+
+if __name__ == "__main__":
+    sys.exit(0 if run_stress_test() else 1)
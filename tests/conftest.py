@@ -0,0 +1,42 @@
+import asyncio
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def server(loop):
+    """The API module, imported without running its startup migrations.
+
+    server.py schedules its startup task at import time, so it is imported
+    on a running loop and the task is cancelled before it gets to run. The
+    Motor client connects lazily, so no database is needed until a test
+    actually queries one.
+    """
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "impulsa_guayaquil_test")
+    sys.path.insert(0, str(BACKEND_DIR))
+
+    async def load():
+        module = importlib.import_module("server")
+        module.startup_task.cancel()
+        return module
+
+    return loop.run_until_complete(load())
+
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+
+def signed_token(server, expires_at):
+    return server.create_signed_qr_token("user-1", "event-1", server.EligibilityStatus.ELIGIBLE, expires_at)
+
+
+def test_used_token_is_rejected_once_its_marker_has_expired(server, run):
+    # The single-use marker lives until expiry + the sync window, so a scan
+    # synced after that must be refused before the marker is consulted
+    expires_at = datetime.utcnow() - timedelta(hours=server.QR_OFFLINE_SYNC_WINDOW_HOURS, minutes=5)
+    token = signed_token(server, expires_at)
+    backdated = server.QRScan(token=token, scanned_at=expires_at - timedelta(minutes=1))
+
+    results = run(server.claim_qr_tokens([backdated], device_id="door-1", offline=True))
+
+    assert results == [{"token": token, "valid": False, "reason": "sync_window_closed"}]
+
+
+def test_sync_window_applies_only_to_offline_scans(server, run):
+    expires_at = datetime.utcnow() - timedelta(hours=server.QR_OFFLINE_SYNC_WINDOW_HOURS, minutes=5)
+    token = signed_token(server, expires_at)
+
+    results = run(server.claim_qr_tokens([server.QRScan(token=token)], device_id="door-1"))
+
+    assert results == [{"token": token, "valid": False, "reason": "expired"}]
+
+
+def test_window_is_measured_from_expiry(server):
+    now = datetime.utcnow()
+    window = timedelta(hours=server.QR_OFFLINE_SYNC_WINDOW_HOURS)
+
+    assert not server.offline_sync_window_closed(now - window + timedelta(minutes=5))
+    assert server.offline_sync_window_closed(now - window - timedelta(minutes=5))
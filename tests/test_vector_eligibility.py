@@ -0,0 +1,111 @@
+import json
+
+import numpy as np
+import pytest
+
+USERS = [
+    {"id": "u-new", "points": 0, "current_streak": 0, "completed_missions": [], "documents": set()},
+    {"id": "u-mid", "points": 300, "current_streak": 3, "completed_missions": ["m1"], "documents": {"ruc"}},
+    {
+        "id": "u-legal",
+        "points": 500,
+        "current_streak": 7,
+        "completed_missions": ["m1", "m2", "retired"],
+        "documents": {"ruc", "cedula"}
+    },
+    {"id": "u-retired", "points": 120, "current_streak": 1, "completed_missions": ["retired"], "documents": {"cedula"}},
+]
+
+# "ghost" is in no catalog area and nobody completed it; "retired" was completed but left the catalog
+AREA_MISSIONS = {"legal": ["m1", "m2", "m3"], "marketing": ["m4"]}
+
+CONDITIONS = [
+    {"and": []},
+    {"or": []},
+    {"and": "not a list"},
+    {"points": {"min": 0}},
+    {"streak": {"min": 0}},
+    {"points": {"min": 500}},
+    {"xp": {"min": 100}},
+    {"streak": 5},
+    {"missions": ["m1", "ghost"]},
+    {"missions": ["retired"]},
+    {"missions": []},
+    {"documents": ["ruc", "cedula"]},
+    {"documents": []},
+    {"competence_area": "legal", "min_missions": 2},
+    {"competence_area": "legal", "min_missions": 0},
+    {"competence_area": "marketing"},
+    {"competence_area": "not_in_catalog"},
+    {"or": [{"missions": ["ghost"]}, {"points": {"min": 300}}]},
+    {"and": [{"or": []}, {"streak": {"min": 3}}]},
+    {"and": [{"missions": ["m1"]}, {"documents": ["ruc"]}, {"points": {"min": 250}}]},
+    {"or": [{"and": []}, {"missions": ["ghost"]}]},
+    {"unknown": 1},
+    [],
+]
+
+
+def snapshot_of(server, users):
+    mission_columns, document_columns = {}, {}
+    for user in users:
+        for mission_id in user["completed_missions"]:
+            mission_columns.setdefault(mission_id, len(mission_columns))
+        for document_type in sorted(user["documents"]):
+            document_columns.setdefault(document_type, len(document_columns))
+
+    completed = np.zeros((len(users), len(mission_columns)), dtype=bool)
+    approved = np.zeros((len(users), len(document_columns)), dtype=bool)
+    for row, user in enumerate(users):
+        for mission_id in user["completed_missions"]:
+            completed[row, mission_columns[mission_id]] = True
+        for document_type in user["documents"]:
+            approved[row, document_columns[document_type]] = True
+
+    return server.UserSnapshot(
+        [user["id"] for user in users],
+        np.array([user["points"] for user in users], dtype=np.int64),
+        np.array([user["current_streak"] for user in users], dtype=np.int64),
+        completed,
+        mission_columns,
+        approved,
+        document_columns
+    )
+
+
+def compile_rules(server, rules):
+    return [
+        server.CompiledEligibilityRule(server.EligibilityRule(
+            event_id="event-1", rule_name=f"rule-{i}", condition=json.dumps(condition), weight=weight
+        ))
+        for i, (condition, weight) in enumerate(rules)
+    ]
+
+
+def assert_paths_agree(server, compiled_rules):
+    snapshot = snapshot_of(server, USERS)
+    percentages, rule_met = server.score_snapshot_eligibility(compiled_rules, snapshot, AREA_MISSIONS)
+
+    for row, user in enumerate(USERS):
+        facts = server.build_eligibility_facts(user, user["documents"], AREA_MISSIONS)
+        eligibility = server.score_event_eligibility("event-1", user["id"], compiled_rules, facts)
+
+        # Exact equality: the vectorized path must reproduce the per-user floats, not approximate them
+        assert percentages[row] == eligibility.eligibility_percentage, user["id"]
+        missing = {requirement["rule_name"] for requirement in eligibility.missing_requirements}
+        for rule_name, met in rule_met.items():
+            assert bool(met[row]) == (rule_name not in missing), (user["id"], rule_name)
+
+
+@pytest.mark.parametrize("condition", CONDITIONS, ids=json.dumps)
+def test_single_rule_matches_per_user_evaluation(server, condition):
+    assert_paths_agree(server, compile_rules(server, [(condition, 1.0)]))
+
+
+def test_weighted_rules_match_per_user_evaluation(server):
+    rules = [(condition, weight) for condition, weight in zip(CONDITIONS, [0.3, 0.7, 2.0, 1.0, 0.1] * 5)]
+    assert_paths_agree(server, compile_rules(server, rules))
+
+
+def test_no_rules_means_everyone_is_eligible(server):
+    assert_paths_agree(server, [])